@@ -0,0 +1,32 @@
+# measure the cost of tasks creation
+import time
+
+import nuka
+from nuka.hosts import LocalHost
+from nuka.task import Task
+from nuka.task import get_task_from_stack
+
+host = LocalHost()
+
+
+class noop(Task):
+
+    def __init__(self, **kwargs):
+        # do not run the task
+        self.initialize(**kwargs)
+
+
+async def bench(host, count=10000):
+    start = time.time()
+    for i in range(count):
+        noop(name=i)
+    print('{0} tasks created in {1:.3f}s'.format(count, time.time() - start))
+    start = time.time()
+    for i in range(count):
+        get_task_from_stack()
+    print('{0} get_task_from_stack() in {1:.3f}s'.format(
+        count, time.time() - start))
+
+nuka.run(
+    bench(host),
+)
@@ -6,6 +6,11 @@ nuka.run
 
 .. autofunction:: run
 
+nuka.run_rolling
+================
+
+.. autofunction:: run_rolling
+
 nuka.wait
 ==========
 
@@ -25,6 +30,7 @@ import concurrent
 import functools
 import logging
 import asyncio
+import math
 import atexit
 import signal
 import shutil
@@ -160,6 +166,88 @@ def run_all(coro, *hosts, **kwargs):
     return run(*[coro(h) for h in hosts], **kwargs)
 
 
+def _count(value, total):
+    """return an int from a number or a percentage of total"""
+    if isinstance(value, str) and value.endswith('%'):
+        value = math.ceil(total * float(value[:-1]) / 100)
+    return max(int(value), 1)
+
+
+def run_rolling(coro, *hosts, batch_size=None, max_concurrency=None,
+                max_failures=None, on_batch=None, timeout=None):
+    """Run ``coro(host)`` for all hosts in successive batches:
+
+    .. code-block:: python
+
+        nuka.run_rolling(do_something, *hosts,
+                         batch_size='10%', max_concurrency=50,
+                         max_failures=2)
+
+    ``batch_size`` and ``max_failures`` are numbers of hosts or percentages.
+    At most ``max_concurrency`` coroutines run at the same time. Once
+    ``max_failures`` hosts failed, no more coroutines are started.
+    ``on_batch(hosts, results)`` is called after each batch. It may
+    return ``False`` to stop. Return the results of the hosts which ran.
+    Failures are returned as exceptions"""
+    hosts = list(hosts)
+    batch_size = _count(batch_size or len(hosts) or 1, len(hosts))
+    if max_failures is not None:
+        max_failures = _count(max_failures, len(hosts))
+    semaphore = asyncio.Semaphore(
+        _count(max_concurrency or batch_size, len(hosts)), loop=loop)
+    # stopped is set to the reason why no more hosts are started
+    state = {'failures': 0, 'stopped': None}
+
+    skipped = object()
+
+    async def start(host, coro):
+        # results are wrapped in a tuple so run() does not exit on failures
+        async with semaphore:
+            if state['stopped']:
+                coro.close()
+                return (skipped,)
+            try:
+                res = await coro
+            except (Exception, asyncio.CancelledError) as e:
+                res = e
+            if isinstance(res, BaseException) or host.failed():
+                state['failures'] += 1
+                if max_failures and state['failures'] >= max_failures:
+                    state['stopped'] = 'max_failures'
+            return (res,)
+
+    results = []
+    for i in range(0, len(hosts), batch_size):
+        if state['stopped']:
+            break
+        batch = hosts[i:i + batch_size]
+        logging.info('Batch {0}/{1}: {2}'.format(
+            i // batch_size + 1, math.ceil(len(hosts) / batch_size), batch))
+        coros = []
+        for host in batch:
+            c = coro(host)
+            wrapper = start(host, c)
+            # used by run() to log the coroutine
+            wrapper.__name__ = c.__name__
+            coros.append(wrapper)
+        res = [r[0] for r in run(*coros, timeout=timeout)]
+        ran = [(h, r) for h, r in zip(batch, res) if r is not skipped]
+        results.extend([r for h, r in ran])
+        if on_batch is not None:
+            if on_batch([h for h, r in ran], [r for h, r in ran]) is False:
+                state['stopped'] = state['stopped'] or 'on_batch'
+
+    remaining = len(hosts) - len(results)
+    if remaining and state['stopped'] == 'max_failures':
+        logging.error('Stopped after {0} failure(s). {1} host(s) skipped'
+                      .format(state['failures'], remaining))
+    elif remaining:
+        # on_batch is not an error
+        logging.info('Stopped by on_batch. {0} host(s) skipped'
+                     .format(remaining))
+    return results
+
+
 def on_sigint(*args, **kwargs):
     hosts = config['all_hosts'].values()
     run_vars['sigint'] = run_vars['sigint'] + 1
@@ -171,7 +259,7 @@ def on_sigint(*args, **kwargs):
             tasks = host.running_tasks()
             if not host.fully_booted.done():
                 host.log.info('Cancelling {0}...'.format(tasks))
-                executor.shutdown(wait=False)
+                shutdown_executors(wait=False)
             else:
                 all_tasks += len(tasks)
                 if tasks:
@@ -185,10 +273,16 @@ def on_sigint(*args, **kwargs):
             loop.create_task(host.send_messages(dict(signal='SIGINT')))
     elif run_vars['sigint'] > 2:
         logging.warning('Exploding...')
-        executor.shutdown(wait=False)
+        shutdown_executors(wait=False)
         sys.exit(1)
 
 
+def shutdown_executors(**kwargs):
+    from nuka.hosts import base
+    executor.shutdown(**kwargs)
+    base.shutdown_executors(**kwargs)
+
+
 def on_exit():
     if cli.finalized and not cli.help:
         if 'all_hosts' in config and 'remote_dir' in config:
@@ -199,8 +293,10 @@ def on_exit():
                 loop.run_until_complete(asyncio.wait(coros))
             if hosts:
                 reports.build_reports(hosts)
-        executor.shutdown(wait=True)
+        shutdown_executors(wait=True)
         process.close_connections()
+        from nuka.hosts import docker_api
+        docker_api.close_connections()
         loop.close()
         dirname = config['tmp']
         if os.path.isdir(dirname):
@@ -39,7 +39,22 @@ class Cli(argparse.ArgumentParser):
         proc = self.add_argument_group('processes')
         proc.add_argument('-d', '--connections-delay', type=float,
                           metavar='DELAY', default=.2,
-                          help='delay ssh connections. Default: 0.2')
+                          help=('initial delay between ssh connections. '
+                                'The rate adapts to timeouts and refusals. '
+                                'Default: 0.2'))
+        proc.add_argument('--provider-workers', type=int, metavar='N',
+                          default=None,
+                          help=('max concurrent node creations/deletions '
+                                'per provider. Default: 20'))
+        proc.add_argument('--agent', action='store_true', default=False,
+                          help=('run tasks in a persistent remote process '
+                                'instead of one process per task'))
+        proc.add_argument('--batch', action='store_true', default=False,
+                          help=('run tasks queued at the same time in a '
+                                'single remote process'))
+        proc.add_argument('--facts', action='store_true', default=False,
+                          help=('skip tasks which did not change anything '
+                                'last time if the host did not change'))
         misc = self.add_argument_group('misc')
         misc.add_argument('--ssh', action='store_true', default=False,
                           help='use ssh binary instead of asyncssh')
@@ -73,4 +88,5 @@ class Cli(argparse.ArgumentParser):
 cli = Cli(add_help=False)
 
 if config['testing']:
-    cli.parse_args(['-vvvvvv', '--tempdir=/tmp/nuka_provisionning'])
+    cli.parse_args(['-vvvvvv', '--tempdir=/tmp/nuka_provisionning',
+                    '--nuka-dir=/tmp/nuka_testing'])
@@ -14,20 +14,37 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with nuka. If not, see <http://www.gnu.org/licenses/>.
+from collections import OrderedDict
 import tempfile
+import hashlib
 import logging
+import json
 import os
 
 import jinja2
+import jinja2.meta
 import yaml
 
 from nuka.utils import CHANGED
 from nuka.gpg import FileSystemLoader
+from nuka.gpg import FileSystemBytecodeCache
 
 
 asyncio_logger = logging.getLogger('asyncio')
 
 
+def is_plain(value):
+    """return True if value survives a json round trip unchanged"""
+    if value is None or isinstance(value, (str, bool, int, float)):
+        return True
+    elif type(value) is list:
+        return all(is_plain(v) for v in value)
+    elif type(value) is dict:
+        return all(isinstance(k, str) and is_plain(v)
+                   for k, v in value.items())
+    return False
+
+
 class Config(dict):
 
     def update_from_file(self, yaml_config):  # pragma: no cover
@@ -91,6 +108,18 @@ class Config(dict):
         if args.connections_delay or 'delay' not in self['connections']:
             self['connections']['delay'] = args.connections_delay
 
+        if args.provider_workers:
+            self['executors']['create'] = args.provider_workers
+
+        if args.agent or 'enabled' not in self['agent']:
+            self['agent']['enabled'] = args.agent
+
+        if args.batch or 'batch' not in self['agent']:
+            self['agent']['batch'] = args.batch
+
+        if args.facts or 'enabled' not in self['facts']:
+            self['facts']['enabled'] = args.facts
+
     def get_template_engine(self):
         engine = self.get('template_engine')
         if engine is None:
@@ -104,29 +133,89 @@ class Config(dict):
             loader = jinja2.ChoiceLoader([
                 FileSystemLoader(p) for p in templates
             ] + [jinja2.PackageLoader('nuka')])
+            dirname = os.path.join(self['nuka_dir'], 'templates')
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
             self['template_engine'] = jinja2.Environment(
                 loader=loader,
                 undefined=jinja2.StrictUndefined,
                 keep_trailing_newline=True,
                 autoescape=False,
+                bytecode_cache=FileSystemBytecodeCache(dirname),
             )
+            self['template_renders'] = OrderedDict()
+            self['template_variables'] = {}
         return self['template_engine']
 
+    def get_template_variables(self, template):
+        """return the variables used by a template. None if the template
+        includes other templates"""
+        key = (template.filename, os.path.getmtime(template.filename))
+        variables = self['template_variables'].get(key, False)
+        if variables is False:
+            engine = self.get_template_engine()
+            source, _, _ = engine.loader.get_source(engine, template.name)
+            ast = engine.parse(source)
+            if list(jinja2.meta.find_referenced_templates(ast)):
+                variables = None
+            else:
+                variables = sorted(jinja2.meta.find_undeclared_variables(ast))
+            self['template_variables'][key] = variables
+        return variables
+
+    def render_template(self, src, ctx):
+        """render a template. Results are cached by template mtime and
+        by the values of the variables used by the template"""
+        engine = self.get_template_engine()
+        template = engine.get_template(src)
+        variables = self.get_template_variables(template)
+        if variables is None:
+            return template.render(ctx)
+        values = [(k, k in ctx, ctx.get(k)) for k in variables]
+        if not all(is_plain(v) for k, i, v in values):
+            # json can't tell tuples from lists, int keys from str keys,
+            # etc. Only plain values are cached
+            return template.render(ctx)
+        values = json.dumps(values, sort_keys=True)
+        key = (template.filename,
+               os.path.getmtime(template.filename),
+               hashlib.sha1(values.encode('utf8')).hexdigest())
+        renders = self['template_renders']
+        data = renders.get(key)
+        if data is None:
+            data = renders[key] = template.render(ctx)
+            if len(renders) > self['template_cache_size']:
+                renders.popitem(last=False)
+        else:
+            renders.move_to_end(key)
+        return data
+
 
 config = Config()
 config['id'] = id(config)
 config['testing'] = 'TESTING' in os.environ
 config['templates'] = []
+# max number of rendered templates kept in memory
+config['template_cache_size'] = 256
 
 config['nuka_dir'] = '.nuka'
 
+# remote directory used to keep archives between runs. Expanded by the
+# remote shell. Archives are not cached if the directory is not private
+config['remote_cache'] = '/var/tmp/nuka-$USER'
+
 config['inventory_modules'] = []
+# cache inventory sections in remote_cache (see inventory_ttl in modules)
+config['inventory_cache'] = True
 
 config['sudo'] = 'sudo'
 config['su'] = 'su -l'
 
 config['docker'] = {
     'use_api': False,
+    'socket': '/var/run/docker.sock',
+    # max concurrent requests to the daemon
+    'max_connections': 32,
 }
 
 config['ssh'] = {
@@ -137,7 +226,13 @@ config['ssh'] = {
        '-oControlPath={dirname}/%r@%h:%p',
     ],
 }
-config['connections'] = {'delay': .2}
+config['connections'] = {'delay': .2, 'max_rate': 50}
+config['executors'] = {'api': 10, 'create': 20}
+# polling of created cloud nodes. delays grow up to max_poll_delay
+config['cloud'] = {'poll_delay': 5, 'max_poll_delay': 30, 'timeout': 900}
+config['agent'] = {}
+config['protocol'] = {'codec': 'auto'}
+config['facts'] = {}
 config['log'] = {
     'dirname': '{nuka_dir}/logs',
     'stdout': '{nuka_dir}/logs/stdout.log',
@@ -0,0 +1,105 @@
+# Copyright 2017 by Bearstech <py@bearstech.com>
+#
+# This file is part of nuka.
+#
+# nuka is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# nuka is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with nuka. If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import os
+
+from nuka.configuration import config
+
+
+class Facts(object):
+    """Results of unchanged tasks for a host, stored in ``nuka_dir`` between
+    runs. A result is reused when the remote fingerprints of the task's
+    :meth:`~nuka.task.Task.state_paths` did not change"""
+
+    def __init__(self, host):
+        self.host = host
+        self.filename = os.path.join(
+            config['nuka_dir'], 'facts', '{0}.json'.format(host.name))
+        self.entries = {}
+        if os.path.isfile(self.filename):
+            try:
+                with open(self.filename) as fd:
+                    self.entries = json.load(fd)
+            except ValueError:  # pragma: no cover
+                pass
+        # a (task, valid) list collecting the remote fingerprints
+        self.collect = None
+
+    def key(self, task, args):
+        """return a key identifying a task and its arguments"""
+        data = json.dumps([
+            task.__class_name__(), task.switch_user, task.switch_ssh_user,
+            args], sort_keys=True)
+        return hashlib.sha1(data.encode('utf8')).hexdigest()
+
+    def dirty(self):
+        """a task is running on the host. collected fingerprints may be
+        outdated"""
+        if self.collect is not None:
+            self.collect[1] = False
+            self.collect = None
+
+    async def fingerprints(self, retries=3):
+        """return fingerprints of all known paths. None if other tasks kept
+        running on the host during the collections"""
+        from nuka.tasks.file import fingerprints
+        for i in range(retries):
+            if self.collect is None:
+                paths = set()
+                for entry in self.entries.values():
+                    paths.update(entry['fingerprints'])
+                self.collect = [
+                    fingerprints(paths=sorted(paths), host=self.host), True]
+            collect = self.collect
+            task = await collect[0]
+            if task.res['rc'] != 0:
+                return None
+            if collect[1]:
+                return task.res['fingerprints']
+
+    async def get(self, key):
+        """return the cached result for key if the host did not change"""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        fingerprints = await self.fingerprints()
+        if fingerprints is None:
+            return None
+        for path, value in entry['fingerprints'].items():
+            if fingerprints.get(path) != value:
+                return None
+        return entry['res']
+
+    def set(self, key, res, fingerprints):
+        """store the result of a task which did not change anything"""
+        res = dict(res)
+        for k in ('meta', 'log', 'message_type'):
+            res.pop(k, None)
+        self.entries[key] = {'fingerprints': fingerprints, 'res': res}
+
+    def discard(self, key):
+        self.entries.pop(key, None)
+
+    def save(self):
+        dirname = os.path.dirname(self.filename)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        with open(self.filename + '.tmp', 'w') as fd:
+            json.dump(self.entries, fd)
+        os.rename(self.filename + '.tmp', self.filename)
@@ -17,9 +17,12 @@
 
 import os
 import yaml
+import asyncio
+import threading
 import subprocess
 
 import jinja2
+from jinja2.bccache import Bucket
 from jinja2.utils import open_if_exists
 from jinja2.loaders import split_template_path
 from jinja2.exceptions import TemplateNotFound
@@ -54,15 +57,58 @@ class FileSystemLoader(jinja2.FileSystemLoader):
         raise TemplateNotFound(template)
 
 
-def decrypt(filename, encoding='utf8'):
-    cmd = ['gpg', '--quiet', '--batch', '-d', filename]
+class FileSystemBytecodeCache(jinja2.FileSystemBytecodeCache):
+    """store compiled templates on disk. Encrypted templates are never
+    stored"""
+
+    def get_bucket(self, environment, name, filename, source):
+        if filename and filename.endswith('.gpg'):
+            return Bucket(environment, None, None)
+        return super().get_bucket(environment, name, filename, source)
+
+    def set_bucket(self, bucket):
+        if bucket.key is not None:
+            super().set_bucket(bucket)
+
+
+# decrypted files. keys are (path, mtime)
+_cache = {}
+_locks = {}
+
+
+def gpg_output(filename):
+    """return the raw output of gpg for filename. Each file is only
+    decrypted once while its mtime does not change. Thread safe"""
+    path = os.path.abspath(filename)
+    lock = _locks.setdefault(path, threading.Lock())
+    with lock:
+        key = (path, os.path.getmtime(path))
+        value = _cache.get(key)
+        if value is None:
+            cmd = ['gpg', '--quiet', '--batch', '-d', filename]
+            try:
+                value = subprocess.check_output(cmd)
+            except subprocess.CalledProcessError:
+                raise
+                raise RuntimeError((
+                    'Error while trying to decrypt {0}. '
+                    'Maybe your GPG agent has expired'.format(filename)))
+            _cache[key] = value
+    return value
+
+
+def is_cached(filename):
+    """return True if gpg's output for filename is cached"""
+    path = os.path.abspath(filename)
     try:
-        value = subprocess.check_output(cmd)
-    except subprocess.CalledProcessError:
-        raise
-        raise RuntimeError((
-            'Error while trying to decrypt {0}. '
-            'Maybe your GPG agent has expired'.format(filename)))
+        return (path, os.path.getmtime(path)) in _cache
+    except OSError:
+        # let the caller fail
+        return True
+
+
+def decrypt(filename, encoding='utf8'):
+    value = gpg_output(filename)
     if filename.endswith('.gpg'):
         filename = filename[:-4]
     if filename.endswith(('.yaml', '.yml')):
@@ -70,3 +116,20 @@ def decrypt(filename, encoding='utf8'):
     if isinstance(value, bytes):
         value = value.decode(encoding)
     return filename, value
+
+
+async def decrypt_files(filenames, loop=None):
+    """decrypt files in the loop's executor so the loop is not blocked.
+    Results are cached so tasks using those files later do not need to run
+    gpg. Useful before starting tasks on many hosts:
+
+    .. code-block:: python
+
+        await gpg.decrypt_files(glob.glob('secrets/*.gpg'))
+    """
+    if loop is None:
+        loop = asyncio.get_event_loop()
+    await asyncio.gather(*[
+        loop.run_in_executor(None, gpg_output, filename)
+        for filename in filenames
+    ], loop=loop)
@@ -18,15 +18,18 @@
 import os
 import sys
 import time
+import heapq
 import asyncio
+import itertools
 import resource
+import concurrent.futures
 from operator import itemgetter
-from collections import deque
 from collections import OrderedDict
 
 import nuka
 from nuka import log
 from nuka import process
+from nuka.facts import Facts
 from nuka.task import wait_for_boot
 from nuka.task import get_task_from_stack
 from nuka.task import destroy as destroy_task
@@ -36,10 +39,79 @@ resource.setrlimit(resource.RLIMIT_NOFILE, (RLIMIT_NOFILE, RLIMIT_NOFILE))
 MAX_PROCESSES = int(RLIMIT_NOFILE / 4)
 
 
+class Slots(object):
+    """A semaphore which wakes up waiters by priority then in FIFO order as
+    soon as a slot is released. ``len()`` return the number of used slots"""
+
+    def __init__(self, value):
+        self.value = value
+        self.used = 0
+        self.waiters = []
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return self.used
+
+    async def acquire(self, loop, priority=0):
+        if self.used < self.value and not self.waiters:
+            self.used += 1
+            return
+        waiter = asyncio.Future(loop=loop)
+        heapq.heappush(self.waiters, (-priority, next(self.counter), waiter))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # we got a slot but we will not use it
+                self.release()
+            raise
+
+    def release(self):
+        while self.waiters:
+            waiter = heapq.heappop(self.waiters)[2]
+            if not waiter.done():
+                # give our slot to the waiter
+                waiter.set_result(True)
+                return
+        self.used -= 1
+
+    def cancel(self):
+        """cancel all waiters"""
+        for waiter in self.waiters:
+            waiter[2].cancel()
+        self.waiters = []
+
+
+# slots shared by all hosts
+processes = Slots(MAX_PROCESSES)
+
+# thread pools used for blocking provider calls
+executors = {}
+
+
+def get_executor(provider, kind='api'):
+    """return the thread pool used for a provider's blocking calls. Slow
+    calls (``create``: create/destroy nodes) use their own pool so they do
+    not delay fast ones (``api``: list/inspect)"""
+    executor = executors.get((provider, kind))
+    if executor is None:
+        sizes = dict(nuka.config['executors'])
+        provider_config = nuka.config.get(str(provider).lower()) or {}
+        sizes.update(provider_config.get('executors') or {})
+        executor = concurrent.futures.ThreadPoolExecutor(sizes[kind])
+        executors[(provider, kind)] = executor
+    return executor
+
+
+def shutdown_executors(wait=True):
+    for executor in executors.values():
+        executor.shutdown(wait=wait)
+
+
 class HostGroup(OrderedDict):
     """A dict like object to group hosts"""
 
-    async def boot(self):
+    async def boot(self, task=None):
         raise NotImplementedError()
 
     async def destroy(self):  # pragma: no cover
@@ -75,7 +147,6 @@ class TimeIt(object):
 class BaseHost(object):
 
     provider = None
-    processes_count = 0
     stds = dict(
         stdin=asyncio.subprocess.PIPE,
         stdout=asyncio.subprocess.PIPE,
@@ -98,11 +169,16 @@ class BaseHost(object):
 
         self.loop = vars.pop('loop', asyncio.get_event_loop())
 
-        self._sessions = deque()
+        self._sessions = Slots(self.max_sessions)
         self._cancelled = False
         self._failed = None
         self._start = time.time()
         self._processes = {}
+        self._agents = {}
+        self._batches = {}
+        self._batch_agents = set()
+        self._facts = None
+        self._merges = {}
         self._tasks = []
         self._named_tasks = {}
         self._task_times = []
@@ -117,6 +193,13 @@ class BaseHost(object):
 
         all_hosts[self.name] = self
 
+    @property
+    def facts(self):
+        """host's :class:`~nuka.facts.Facts`"""
+        if self._facts is None:
+            self._facts = Facts(self)
+        return self._facts
+
     @property
     def log(self):
         if self._log is None:
@@ -142,10 +225,24 @@ class BaseHost(object):
         else:  # pragma: no cover
             self.log.warning("can't retrieve task\n{}".format(kwargs))
 
+    async def run_in_executor(self, func, kind='api', task=None):
+        """run a blocking provider call in the provider's executor. The
+        time spent waiting for a thread is recorded"""
+        queued = time.time()
+
+        def call():
+            if task is not None:
+                self.add_time(type='api_call', task=task, start=queued,
+                              name='queue({0})'.format(kind))
+            return func()
+        executor = get_executor(self.provider, kind)
+        return await self.loop.run_in_executor(executor, call)
+
     def cancel(self):
         for task in self.running_tasks():
             if not task.done():  # pragma: no cover
                 task.cancel()
+        self._sessions.cancel()
         self._cancelled = True
 
     def cancelled(self):
@@ -225,26 +322,27 @@ class BaseHost(object):
         self.vars['destroyed'] = True
         return dict(rc=0)
 
-    async def acquire_session_slot(self):
-        while self.processes_count > MAX_PROCESSES:
-            self.log.debug5('wait for free fds')
-            await asyncio.sleep(.5, loop=self.loop)
+    async def acquire_session_slot(self, task=None):
+        """wait for a free session on the host and a free process slot.
+        Tasks with a higher ``priority`` get slots first"""
+        if self.cancelled():
+            raise asyncio.CancelledError()
+        priority = getattr(task, 'priority', 0)
         sessions = self._sessions
-        ll = len(sessions)
-        if ll >= self.max_sessions:  # pragma: no cover
+        if len(sessions) >= self.max_sessions:  # pragma: no cover
             self.log.debug5('wait for a session')
-            while ll >= self.max_sessions:
-                if not self.cancelled():
-                    await asyncio.sleep(.5, loop=self.loop)
-                else:
-                    return sessions
-                ll = len(sessions)
-        self.__class__.processes_count += 1
-        sessions.append(1)
+        await sessions.acquire(self.loop, priority)
+        try:
+            if len(processes) >= MAX_PROCESSES:  # pragma: no cover
+                self.log.debug5('wait for free fds')
+            await processes.acquire(self.loop, priority)
+        except BaseException:
+            sessions.release()
+            raise
 
     def free_session_slot(self):
-        self.__class__.processes_count -= 1
-        self._sessions.pop()
+        processes.release()
+        self._sessions.release()
 
     async def create_process(self, cmd, task=None, **kwargs):
         if self.cancelled():
@@ -253,6 +351,95 @@ class BaseHost(object):
         proc = await process.create(process_cmd, self, task)
         return proc
 
+    async def get_agent(self, cmd, task=None, **kwargs):
+        """return a running :class:`~nuka.process.Agent` for the user. Start
+        it using cmd if needed"""
+        key = (kwargs.get('switch_user'), kwargs.get('switch_ssh_user'))
+        agent = self._agents.get(key)
+        if agent is not None and agent.done() and not agent.cancelled():
+            if agent.exception() is None and agent.result().closed:
+                agent = None
+        if agent is None:
+            agent = self._agents[key] = self.loop.create_task(
+                self._start_agent(cmd, task=task, **kwargs))
+        try:
+            return await asyncio.shield(agent, loop=self.loop)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self._agents.pop(key, None)
+            raise
+
+    async def _start_agent(self, cmd, task=None, **kwargs):
+        cmd = '{0} --agent'.format(cmd.strip())
+        proc = await self.create_process(cmd, task=task, **kwargs)
+        return process.Agent(self, proc)
+
+    async def get_batch(self, cmd, task=None, **kwargs):
+        """return an :class:`~nuka.process.Agent` shared by all tasks queued
+        during the same loop iteration. The agent is closed once all those
+        tasks are done"""
+        key = (kwargs.get('switch_user'), kwargs.get('switch_ssh_user'))
+        batch = self._batches.get(key)
+        if batch is None:
+            batch = self._batches[key] = [self.loop.create_task(
+                self._start_batch(cmd, key, task=task, **kwargs)), 0]
+        batch[1] += 1
+        agent = batch[0]
+        try:
+            return await asyncio.shield(agent, loop=self.loop)
+        except asyncio.CancelledError:
+            if agent.done() and not agent.cancelled():
+                if agent.exception() is None:
+                    agent.result().release()
+            else:
+                batch[1] -= 1
+            raise
+
+    async def _start_batch(self, cmd, key, task=None, **kwargs):
+        # let tasks queued during the same loop iteration join the batch
+        await asyncio.sleep(0, loop=self.loop)
+        batch = self._batches.pop(key)
+        # keep the batch until its agent is done so teardown can wait for it
+        self._batch_agents.add(batch[0])
+        try:
+            agent = await self._start_agent(cmd, task=task, **kwargs)
+        except BaseException:
+            self._batch_agents.discard(batch[0])
+            raise
+        agent.reader.add_done_callback(
+            lambda f: self._batch_agents.discard(batch[0]))
+        agent.pending = batch[1]
+        if agent.pending <= 0:  # pragma: no cover
+            agent.close()
+        return agent
+
+    async def merge_tasks(self, key, task):
+        """return the first task queued with the same key during the same
+        loop iteration. This task runs for the others"""
+        tasks = self._merges.get(key)
+        if tasks is not None:
+            tasks.append(task)
+            return tasks[0]
+        tasks = self._merges[key] = [task]
+        # let tasks queued during the same loop iteration join
+        await asyncio.sleep(0, loop=self.loop)
+        self._merges.pop(key)
+        if len(tasks) > 1:
+            task.merged = tasks[1:]
+            task.merge(task.merged)
+        return task
+
+    async def close_agents(self):
+        tasks = list(self._agents.values()) + list(self._batch_agents)
+        agents = [a.result() for a in tasks
+                  if a.done() and not a.cancelled() and a.exception() is None]
+        self._agents.clear()
+        self._batch_agents.clear()
+        if agents:
+            await asyncio.wait([a.wait_closed() for a in agents],
+                               loop=self.loop)
+
     async def run_command(self, cmd=None, stdin=None, task=None, **kwargs):
         """run a shell command on the remote host"""
         proc = await self.create_process(cmd, task)
@@ -10,6 +10,7 @@ import os
 
 from libcloud.common.google import ResourceNotFoundError
 from libcloud.compute.providers import get_driver
+from libcloud.compute.types import NodeState
 from libcloud.compute.types import Provider
 
 from novaclient.client import Client as NovaClient
@@ -26,6 +27,8 @@ nova_providers = (Provider.OPENSTACK,)
 
 _drivers = defaultdict(dict)
 
+_pollers = {}
+
 _env_keys = {
     Provider.GCE: (
         ('GCE_EMAIL', 'user_id'),
@@ -77,12 +80,120 @@ def driver_from_config(provider, **args):
     return driver
 
 
+def node_status(node):
+    """return ``running``, ``pending`` or ``error``"""
+    if hasattr(node, 'status'):
+        # nova server
+        status = node.status
+        if status == 'ACTIVE':
+            return 'running'
+        elif status == 'ERROR':
+            return 'error'
+    elif node.state == NodeState.RUNNING:
+        return 'running'
+    elif node.state in (NodeState.ERROR, NodeState.TERMINATED):
+        return 'error'
+    return 'pending'
+
+
+class NodesPoller:
+    """Wait for nodes to be running. All pending nodes of a provider are
+    checked with a single ``list_nodes()`` call. The delay between two calls
+    grows exponentially up to ``max_poll_delay``"""
+
+    def __init__(self, provider, driver_args, loop):
+        self.provider = provider
+        self.driver_args = driver_args
+        self.loop = loop
+        self.pending = {}
+        self.poller = None
+
+    def list_nodes(self):
+        driver = driver_from_config(self.provider, **self.driver_args)
+        if self.provider in nova_providers:
+            return {n.name: n for n in driver.servers.list()}
+        return {n.name: n for n in driver.list_nodes()}
+
+    async def wait(self, host, task=None):
+        fut = asyncio.Future(loop=self.loop)
+        self.pending[host.name] = (host, task, fut)
+        if self.poller is None or self.poller.done():
+            self.poller = self.loop.create_task(self.poll())
+        try:
+            return await fut
+        finally:
+            if self.pending.get(host.name, (None, None, None))[2] is fut:
+                # cancelled
+                del self.pending[host.name]
+                if not self.pending and self.poller is not None:
+                    # nobody is waiting anymore
+                    self.poller.cancel()
+
+    async def list_pending_nodes(self):
+        """call list_nodes() in the provider's executor. The call is
+        recorded in the boot task of each waiting host"""
+        times = {'queued': time.time()}
+
+        def call():
+            times['start'] = time.time()
+            return self.list_nodes()
+        executor = base.get_executor(self.provider, 'api')
+        try:
+            return await self.loop.run_in_executor(executor, call)
+        finally:
+            for h, task, fut in self.pending.values():
+                start = times.get('start', time.time())
+                h.add_time(type='api_call', task=task,
+                           start=times['queued'],
+                           time=start - times['queued'], name='queue(api)')
+                h.add_time(type='api_call', task=task, start=start,
+                           name='driver.list_nodes()')
+
+    async def poll(self):
+        config = nuka.config['cloud']
+        delay = config['poll_delay']
+        while self.pending:
+            await asyncio.sleep(delay, loop=self.loop)
+            delay = min(delay * 2, config['max_poll_delay'])
+            if not self.pending:
+                break
+            try:
+                nodes = await self.list_pending_nodes()
+            except Exception as e:
+                for h, task, fut in self.pending.values():
+                    if not fut.done():
+                        fut.set_exception(e)
+                self.pending.clear()
+                return
+            for name, (h, task, fut) in list(self.pending.items()):
+                node = nodes.get(name)
+                if node is None:
+                    continue
+                status = node_status(node)
+                if status == 'running':
+                    del self.pending[name]
+                    fut.set_result(node)
+                elif status == 'error':
+                    del self.pending[name]
+                    fut.set_exception(RuntimeError(
+                        'Node {0} failed to boot'.format(h)))
+
+
+def get_poller(provider, driver_args, loop):
+    """return the poller of a provider for the loop"""
+    key = (loop, provider, utils.json.dumps(driver_args, sort_keys=True))
+    poller = _pollers.get(key)
+    if poller is None:
+        poller = _pollers[key] = NodesPoller(provider, driver_args, loop)
+    return poller
+
+
 class Host(base.Host):
     """Host in the cloud"""
 
     use_sudo = True
 
-    def __init__(self, hostname, node=None,
+    def __init__(self, hostname, node=None, group=None,
                  create=True, driver_args=None, create_node_args=None, **vars):
         config = nuka.config.get(self.provider.lower(), {})
         user = config.get('user') or 'root'
@@ -91,15 +202,29 @@ class Host(base.Host):
         vars['create_node_args'] = create_node_args or {}
         super().__init__(hostname, **vars)
         self.create = create
+        self.group = group
         self._node = node
+        self._created = False
 
     async def boot(self):
         # we need to get the task from here.
         # we cant retrieve it while in an executor
         task = get_task_from_stack()
-        get_node = partial(self.get_node, task=task)
+        get_node = partial(self.get_node, task=task, create=False)
+        create_node = partial(self.create_node, task=task)
         try:
-            self._node = await self.loop.run_in_executor(None, get_node)
+            if self.group is not None:
+                # nodes of the group are listed/created at once
+                await self.group.boot(task)
+                if self.name in self.group._errors:
+                    raise self.group._errors.pop(self.name)
+            if self._node is None:
+                await self.run_in_executor(get_node, task=task)
+            if self._node is None and self.create:
+                await self.run_in_executor(
+                    create_node, kind='create', task=task)
+            if self._created:
+                await self.wait_for_node(task=task)
         except asyncio.CancelledError:
             raise
         except Exception as e:
@@ -120,7 +245,9 @@ class Host(base.Host):
         """return host's private ip"""
         return self.node.private_ips[0]
 
-    def get_node(self, task=None, **kwargs):
+    def get_node(self, task=None, create=None, **kwargs):
+        if create is None:
+            create = self.create
         if self._node is False:
             raise RuntimeError('Node {0} was destroyed'.format(self))
         elif self._node is None:
@@ -139,12 +266,54 @@ class Host(base.Host):
                         self._node = driver.ex_get_node(self.hostname)
                 except (ResourceNotFoundError, NotFound):
                     pass
-            if self._node is None and self.create:
+            if self._node is None and create:
                 self.create_node(driver=driver, task=task)
         return self._node
     node = property(get_node)
 
+    async def wait_for_node(self, task=None):
+        """wait for a created node to be running and accept ssh
+        connections"""
+        config = nuka.config['cloud']
+        start = time.time()
+        if node_status(self._node) != 'running':
+            poller = get_poller(self.provider, self.driver_args, self.loop)
+            self._node = await asyncio.wait_for(
+                poller.wait(self, task=task), config['timeout'],
+                loop=self.loop)
+        timeout = config['timeout'] - (time.time() - start)
+        with self.timeit(type='api_call', task=task, name='ssh probe'):
+            await asyncio.wait_for(self.probe_ssh(), max(timeout, 1),
+                                   loop=self.loop)
+        self.log.warning('Node {0} is running'.format(self))
+
+    async def probe_ssh(self):
+        """return when the ssh server send its banner"""
+        delay = 1
+        while True:
+            try:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(
+                        self.public_ip, int(self.port), loop=self.loop),
+                    5, loop=self.loop)
+            except (OSError, asyncio.TimeoutError, IndexError, KeyError):
+                # connection refused or no public ip yet
+                pass
+            else:
+                try:
+                    banner = await asyncio.wait_for(
+                        reader.readline(), 5, loop=self.loop)
+                except (OSError, asyncio.TimeoutError):
+                    banner = b''
+                writer.close()
+                if banner.startswith(b'SSH-'):
+                    return
+            await asyncio.sleep(delay, loop=self.loop)
+            delay = min(delay * 2, nuka.config['cloud']['max_poll_delay'])
+
     def create_node(self, driver=None, task=None, **kwargs):
+        """submit the node creation. :meth:`wait_for_node` waits for it to
+        be running"""
         self.log.warning(
             'Node {0} does not exist. Creating...'.format(self))
         if driver is None:
@@ -155,27 +324,10 @@ class Host(base.Host):
         with self.timeit(type='api_call', task=task,
                          name='driver.ex_create_node()'):
             if self.provider in nova_providers:
-                node = driver.servers.create(**args)
-                # it take at least 20s to boot a vm
-                time.sleep(20)
-                wait = 15
-                while node.status not in ('ACTIVE',):
-                    try:
-                        node = driver.servers.find(name=self.hostname)
-                    except NotFound:
-                        pass
-                    if node.status in ('ACTIVE',):
-                        # need to wait ~10s to get the server up & running
-                        time.sleep(10)
-                        break
-                    else:
-                        wait = (wait - 5)
-                        if wait < 1:
-                            wait = 2
-                        time.sleep(wait)
-                self._node = node
+                self._node = driver.servers.create(**args)
             else:
                 self._node = driver.create_node(**args)
+            self._created = True
             self.log.warning('Node {0} created'.format(self))
 
     def get_create_node_args(self, driver=None, task=None):
@@ -320,23 +472,68 @@ class Cloud(base.HostGroup):
             args = {'provider': self.provider, 'use_sudo': use_sudo}
             self.host_class = type(name, (Host,), args)
         self._nodes = {}
+        self._booting = None
+        self._errors = {}
 
     @property
     def driver(self):
         return driver_from_config(self.provider, **self.driver_args)
 
-    @property
-    def cached_list_nodes(self):
-        cls = self.__class__
-        if not self._nodes:
-            cls._list_lock.acquire()
+    def list_nodes(self):
+        """retrieve all nodes with a single api call"""
+        with self.__class__._list_lock:
             if self.provider in nova_providers:
                 self._nodes = {n.name: n for n in self.driver.servers.list()}
             else:
                 self._nodes = {n.name: n for n in self.driver.list_nodes()}
-            cls._list_lock.release()
         return self._nodes
 
+    @property
+    def cached_list_nodes(self):
+        if not self._nodes:
+            self.list_nodes()
+        return self._nodes
+
+    async def boot(self, task=None):
+        """List nodes once then create all missing nodes in parallel. Hosts
+        of the group wait for this before their own boot"""
+        if self._booting is None:
+            self._booting = asyncio.ensure_future(self._boot(task))
+        await asyncio.shield(self._booting)
+
+    async def _boot(self, task=None):
+        hosts = [h for h in self.values() if h._node is None]
+        if not hosts:
+            return
+        host = hosts[0]
+        with host.timeit(type='api_call', task=task,
+                         name='driver.list_nodes()'):
+            nodes = await host.run_in_executor(self.list_nodes, task=task)
+        missing = []
+        for h in hosts:
+            node = nodes.get(h.name)
+            if node is None:
+                if h.create:
+                    missing.append(h)
+            else:
+                h._node = node
+                if node_status(node) != 'running':
+                    # still booting. the host must wait for it
+                    h._created = True
+        if missing:
+            # record api calls in each host's boot task
+            coros = []
+            for h in missing:
+                t = h._named_tasks.get('boot', task)
+                coros.append(h.run_in_executor(
+                    partial(h.create_node, task=t), kind='create', task=t))
+            results = await asyncio.gather(*coros, return_exceptions=True)
+            for h, res in zip(missing, results):
+                if isinstance(res, Exception):
+                    self._errors[h.name] = res
+                else:
+                    self._nodes[h.name] = h._node
+
     def __getitem__(self, item):
         if item not in self:
             item = item.replace('_', '-')
@@ -346,6 +543,7 @@ class Cloud(base.HostGroup):
         """Return a Host. Create it if needed"""
         kwargs.setdefault('create', self.create)
         kwargs['driver_args'] = self.driver_args
+        kwargs['group'] = self
         if hostname not in self:
             kwargs.setdefault('node', self._nodes.get(hostname))
             self[hostname] = self.host_class(hostname=hostname, **kwargs)
@@ -375,6 +573,11 @@ class Cloud(base.HostGroup):
 
     async def destroy(self):
         """Destroy all hosts in the group"""
+        loop = asyncio.get_event_loop()
+        executor = base.get_executor(self.provider, 'create')
+        await loop.run_in_executor(executor, self._destroy)
+
+    def _destroy(self):
         nodes = []
         for node in self.cached_list_nodes.values():
             if node.name in self:
@@ -0,0 +1,373 @@
+# Copyright 2017 by Bearstech <py@bearstech.com>
+#
+# This file is part of nuka.
+#
+# nuka is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# nuka is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with nuka. If not, see <http://www.gnu.org/licenses/>.
+"""A minimal asyncio client for the docker Engine API. Talks HTTP/1.1 to the
+daemon's unix socket using a pool of keep-alive connections. Commands run in
+exec instances streamed over a hijacked connection so no docker cli is
+forked."""
+from urllib.parse import quote
+from urllib.parse import urlencode
+import asyncio
+import struct
+import json
+import time
+
+import nuka
+from nuka.process import BaseProcess
+from nuka.process import DEFAULT_LIMIT
+
+apis = {}
+
+STDOUT = 1
+STDERR = 2
+
+
+class APIError(Exception):
+    """raised when the daemon returns an error status"""
+
+    def __init__(self, status, message):
+        super().__init__(status, message)
+        self.status = status
+        self.message = message
+
+    def __str__(self):
+        return '{0.status}: {0.message}'.format(self)
+
+
+class Response:
+
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        if not self.body:
+            return None
+        return json.loads(self.body.decode('utf8'))
+
+
+class DockerAPI:
+    """Keep idle connections to the daemon's socket. At most
+    ``max_connections`` requests are running at the same time. Hijacked
+    connections are not part of the pool"""
+
+    def __init__(self, path, max_connections=32, loop=None):
+        self.path = path
+        self.loop = loop
+        self.idle = []
+        self.slots = asyncio.Semaphore(max_connections, loop=loop)
+
+    async def connect(self):
+        while self.idle:
+            reader, writer = self.idle.pop()
+            if not reader.at_eof() and not writer.transport.is_closing():
+                return reader, writer
+            writer.close()
+        return await asyncio.open_unix_connection(
+            self.path, limit=DEFAULT_LIMIT, loop=self.loop)
+
+    def release(self, reader, writer, keep_alive=True):
+        if keep_alive and not reader.at_eof():
+            self.idle.append((reader, writer))
+        else:
+            writer.close()
+
+    def close(self):
+        while self.idle:
+            reader, writer = self.idle.pop()
+            writer.close()
+
+    def send_request(self, writer, method, path, params=None, body=None,
+                     headers=None):
+        if params:
+            path += '?' + urlencode(params)
+        if body is not None:
+            body = json.dumps(body).encode('utf8')
+        lines = ['{0} {1} HTTP/1.1'.format(method, path), 'Host: docker']
+        if body is not None:
+            lines.append('Content-Type: application/json')
+        lines.append('Content-Length: {0}'.format(len(body or b'')))
+        for k, v in (headers or {}).items():
+            lines.append('{0}: {1}'.format(k, v))
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin1'))
+        if body:
+            writer.write(body)
+
+    async def read_headers(self, reader):
+        line = await reader.readline()
+        if not line:
+            raise ConnectionResetError('docker daemon closed the connection')
+        version, status = line.decode('latin1').split(None, 2)[:2]
+        headers = {}
+        while True:
+            line = await reader.readline()
+            line = line.decode('latin1').strip()
+            if not line:
+                break
+            k, v = line.split(':', 1)
+            headers[k.strip().lower()] = v.strip()
+        keep_alive = version == 'HTTP/1.1' and \
+            headers.get('connection', '').lower() != 'close'
+        return int(status), headers, keep_alive
+
+    async def read_body(self, reader, headers):
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = await reader.readline()
+                if not size:
+                    raise ConnectionResetError(
+                        'docker daemon closed the connection')
+                size = int(size.split(b';')[0].strip(), 16)
+                if size == 0:
+                    # trailers
+                    while (await reader.readline()).strip():
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            return b''.join(chunks), True
+        elif 'content-length' in headers:
+            length = int(headers['content-length'])
+            return await reader.readexactly(length), True
+        # no length. the body ends with the connection
+        return await reader.read(), False
+
+    async def request(self, method, path, params=None, body=None):
+        """perform a request. return a :class:`Response`. Raise
+        :class:`APIError` on errors"""
+        async with self.slots:
+            reader, writer = await self.connect()
+            try:
+                self.send_request(writer, method, path,
+                                  params=params, body=body)
+                status, headers, keep_alive = await self.read_headers(reader)
+                data, complete = await self.read_body(reader, headers)
+            except BaseException:
+                writer.close()
+                raise
+            self.release(reader, writer, keep_alive and complete)
+        resp = Response(status, headers, data)
+        if status >= 400:
+            try:
+                message = resp.json()['message']
+            except (ValueError, TypeError, KeyError):
+                message = data.decode('utf8', 'replace')
+            raise APIError(status, message)
+        return resp
+
+    async def hijack(self, method, path, body=None):
+        """perform a request and return the raw ``(reader, writer)`` of the
+        connection. Used to attach to exec instances"""
+        async with self.slots:
+            reader, writer = await self.connect()
+        try:
+            self.send_request(writer, method, path, body=body, headers={
+                'Connection': 'Upgrade', 'Upgrade': 'tcp'})
+            status, headers, keep_alive = await self.read_headers(reader)
+            if status >= 400:
+                data, complete = await self.read_body(reader, headers)
+                raise APIError(status, data.decode('utf8', 'replace'))
+        except BaseException:
+            writer.close()
+            raise
+        return reader, writer
+
+    async def inspect(self, name):
+        """return the container's infos or None"""
+        try:
+            resp = await self.request(
+                'GET', '/containers/{0}/json'.format(quote(name)))
+        except APIError as e:
+            if e.status == 404:
+                return None
+            raise
+        return resp.json()
+
+    async def has_image(self, image):
+        try:
+            await self.request(
+                'GET', '/images/{0}/json'.format(quote(image, safe='')))
+        except APIError as e:
+            if e.status == 404:
+                return False
+            raise
+        return True
+
+    async def pull(self, image):
+        if '@' in image:
+            # a digest (name@sha256:...). no tag
+            params = dict(fromImage=image)
+        else:
+            name, _, tag = image.rpartition(':')
+            if not name or '/' in tag:
+                # no tag. the colon is a registry's port
+                name, tag = image, ''
+            params = dict(fromImage=name, tag=tag or 'latest')
+        resp = await self.request('POST', '/images/create', params=params)
+        # errors are reported in the progress stream
+        for line in resp.body.decode('utf8').splitlines():
+            if '"error"' in line:
+                raise APIError(resp.status, json.loads(line)['error'])
+
+    async def create(self, name, **config):
+        resp = await self.request('POST', '/containers/create',
+                                  params=dict(name=name), body=config)
+        return resp.json()
+
+    async def start(self, name):
+        """start a container. return False if it's already running"""
+        resp = await self.request(
+            'POST', '/containers/{0}/start'.format(quote(name)))
+        return resp.status != 304
+
+    async def remove(self, name, force=True):
+        await self.request('DELETE', '/containers/{0}'.format(quote(name)),
+                           params=dict(force=int(force)))
+
+
+def get_api(loop=None):
+    """return the shared :class:`DockerAPI`"""
+    config = nuka.config['docker']
+    path = config.get('socket', '/var/run/docker.sock')
+    api = apis.get(path)
+    if api is None:
+        api = apis[path] = DockerAPI(
+            path, max_connections=config.get('max_connections', 32),
+            loop=loop)
+    return api
+
+
+def close_connections():
+    for api in apis.values():
+        api.close()
+
+
+class ExecStdin:
+    """stdin of an exec instance. Closing it only shut the write side of the
+    socket so we can still read the output"""
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    def write(self, data):
+        self.writer.write(data)
+
+    async def drain(self):
+        await self.writer.drain()
+
+    def close(self):
+        if not self.writer.transport.is_closing():
+            if self.writer.can_write_eof():
+                self.writer.write_eof()
+            else:  # pragma: no cover
+                self.writer.close()
+
+
+class DockerExecProcess(BaseProcess):
+    """A command running in an exec instance. Provide the same interface
+    than :class:`~nuka.process.Process`"""
+
+    def __init__(self, api, exec_id, reader, writer, host, task, cmd, start):
+        self.api = api
+        self.exec_id = exec_id
+        self.host = host
+        self.task = task
+        self.cmd = cmd
+        self.start = start
+        self.returncode = None
+        self.waiter = None
+        self.writer = writer
+        self.stdin = ExecStdin(writer)
+        self.stdout = asyncio.StreamReader(limit=DEFAULT_LIMIT, loop=api.loop)
+        self.stderr = asyncio.StreamReader(limit=DEFAULT_LIMIT, loop=api.loop)
+        self.reader = api.loop.create_task(self.demux(reader))
+
+    async def demux(self, reader):
+        """split the multiplexed stream into stdout/stderr"""
+        streams = {STDOUT: self.stdout, STDERR: self.stderr}
+        try:
+            while True:
+                try:
+                    header = await reader.readexactly(8)
+                except asyncio.IncompleteReadError:
+                    break
+                stream, size = struct.unpack('>BxxxL', header)
+                data = await reader.readexactly(size)
+                if stream in streams:
+                    streams[stream].feed_data(data)
+        finally:
+            self.stdout.feed_eof()
+            self.stderr.feed_eof()
+            self.writer.close()
+
+    async def wait(self):
+        if self.waiter is None:
+            self.waiter = self.api.loop.create_task(self.inspect())
+        return await asyncio.shield(self.waiter, loop=self.api.loop)
+
+    async def inspect(self):
+        await self.reader
+        path = '/exec/{0}/json'.format(self.exec_id)
+        while self.returncode is None:
+            infos = (await self.api.request('GET', path)).json()
+            if infos['Running']:
+                # output is closed but the exit code is not known yet
+                await asyncio.sleep(.01, loop=self.api.loop)
+            elif infos.get('ExitCode') is None:  # pragma: no cover
+                self.returncode = -1
+            else:
+                self.returncode = infos['ExitCode']
+        return self.returncode
+
+    async def exit(self):
+        if self.returncode is None:
+            try:
+                await self.wait()
+            except asyncio.CancelledError:
+                pass
+            except Exception:
+                self.host.log.exception5('exec')
+        self.writer.close()
+        self.host.free_session_slot()
+        self.host._processes.pop(id(self), None)
+
+
+async def create(cmd, host, task=None):
+    """create an exec instance running ``cmd`` in the host's container and
+    attach to it"""
+    host.log.debug5(cmd)
+    api = get_api(host.loop)
+    start = time.time()
+    await host.acquire_session_slot(task)
+    try:
+        resp = await api.request(
+            'POST', '/containers/{0}/exec'.format(quote(host.name)),
+            body=dict(Cmd=cmd, AttachStdin=True, AttachStdout=True,
+                      AttachStderr=True, Tty=False))
+        exec_id = resp.json()['Id']
+        reader, writer = await api.hijack(
+            'POST', '/exec/{0}/start'.format(exec_id),
+            body=dict(Detach=False, Tty=False))
+    except BaseException:
+        host.free_session_slot()
+        raise
+    proc = DockerExecProcess(api, exec_id, reader, writer,
+                             host, task, cmd, start)
+    host._processes[id(proc)] = proc
+    host.loop.create_task(proc.exit())
+    return proc
@@ -7,6 +7,7 @@ import sys
 import docker as docker_py
 
 from nuka.task import get_task_from_stack
+from nuka.hosts import docker_api
 from nuka.hosts.base import BaseHost
 from nuka.hosts.base import HostGroup
 from nuka.task import wait_for_boot
@@ -29,6 +30,11 @@ class DockerContainer(BaseHost):
         >>> host = DockerContainer(
         ...     hostname='myhost',
         ...     image='bearstech/nukai:debian-jessie-python3')
+
+    When ``use_api`` is true (or ``nuka.config['docker']['use_api']``)
+    commands run in exec instances created through the daemon's socket
+    instead of forking ``docker exec`` and containers are booted without
+    threads.
     """
 
     provider = 'docker'
@@ -39,6 +45,10 @@ class DockerContainer(BaseHost):
         super().__init__(**kwargs)
         self.cli = DockerClient()
 
+    @property
+    def use_api(self):
+        return self.vars.get('use_api', nuka.config['docker']['use_api'])
+
     @property
     def bootstrap_command(self):
         if 'bootstrap_command' in self.vars:
@@ -57,7 +67,7 @@ class DockerContainer(BaseHost):
                 'yum install -y -q -q python-virtualenv 2>&1 > /dev/null'
             )
 
-    async def acquire_session_slot(self):
+    async def acquire_session_slot(self, task=None):
         return
 
     async def acquire_connection_slot(self):
@@ -87,12 +97,23 @@ class DockerContainer(BaseHost):
         cmd = ['docker', 'exec', '-i', str(self), 'bash', '-c', cmd]
         return cmd
 
+    async def create_process(self, cmd, task=None, **kwargs):
+        if not self.use_api:
+            return await super().create_process(cmd, task=task, **kwargs)
+        if self.cancelled():
+            raise asyncio.CancelledError()
+        # strip docker exec -i {name}
+        process_cmd = self.wraps_command_line(cmd, **kwargs)[4:]
+        return await docker_api.create(process_cmd, self, task)
+
     async def boot(self):
         # we need to get the task from here.
         # we cant retrieve it while in an executor
         task = get_task_from_stack()
+        if self.use_api:
+            return await self._boot_async(task=task)
         boot = partial(self._boot_api, task=task)
-        return await self.loop.run_in_executor(None, boot)
+        return await self.run_in_executor(boot, kind='create', task=task)
 
     def _boot_api(self, task=None):
         with self.timeit(type='api_call', task=task, name='start()'):
@@ -130,6 +151,35 @@ class DockerContainer(BaseHost):
             self.log.debug('Container started'.format(self))
         return container
 
+    async def _boot_async(self, task=None):
+        api = docker_api.get_api(self.loop)
+        with self.timeit(type='api_call', task=task, name='start()'):
+            try:
+                await api.start(self.name)
+            except docker_api.APIError:
+                pass
+        with self.timeit(type='api_call', task=task, name='inspect()'):
+            container = await api.inspect(self.name)
+        if container is None:
+            with self.timeit(type='api_call', task=task, name='images()'):
+                found = await api.has_image(self.image)
+            if not found:
+                with self.timeit(type='api_call', task=task, name='pull()'):
+                    self.log.warning('Pulling image {0}...'.format(self.image))
+                    await api.pull(self.image)
+            self.log.debug('Create container...')
+            with self.timeit(type='api_call', task=task, name='create()'):
+                await api.create(
+                    self.name, Image=self.image, Hostname=self.name,
+                    Cmd=self.vars.get('command', None))
+            with self.timeit(type='api_call', task=task, name='start()'):
+                await api.start(self.name)
+            self.log.debug('Container started')
+            container = await api.inspect(self.name)
+        self.vars['container'] = container
+        self.vars['container_id'] = container['Id']
+        return container
+
     @property
     def private_ip(self):
         if 'private_ip' not in self.vars:
@@ -142,9 +192,12 @@ class DockerContainer(BaseHost):
     public_ip = private_ip
 
     async def destroy(self):
+        if self.use_api:
+            api = docker_api.get_api(self.loop)
+            return await api.remove(self.hostname, force=True)
         remove_container = partial(self.cli.remove_container,
                                    self.hostname, force=True)
-        await self.loop.run_in_executor(None, remove_container)
+        await self.run_in_executor(remove_container, kind='create')
 
 
 class DockerCompose(HostGroup):
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 import importlib
+import sys
+import os
 
 _modules = (
     'zlib', 'psutils',
@@ -8,6 +10,20 @@ _modules = (
     'lxml',
 )
 
+inventory_ttl = 3600
+
+
+def inventory_key():
+    # installing a library (apt, pip) changes the mtime of site-packages
+    mtimes = []
+    for path in sys.path:
+        if path.rstrip('/').endswith(('site-packages', 'dist-packages')):
+            try:
+                mtimes.append([path, os.stat(path).st_mtime])
+            except OSError:
+                mtimes.append([path, None])
+    return [sys.executable, list(sys.version_info), mtimes]
+
 
 def update_inventory(inventory, modules=_modules):
     libs = inventory.setdefault('python_libs', {})
@@ -12,6 +12,11 @@ from ctypes import (
 
 libc = ctypes.CDLL(ctypes.util.find_library('c'))
 
+# resolving the fqdn may be slow. see inventory_key()
+inventory_ttl = 3600
+
+_files = ('/etc/hostname', '/etc/hosts', '/etc/resolv.conf')
+
 
 class struct_sockaddr(Structure):
     _fields_ = [
@@ -73,7 +78,7 @@ def getinfos(ifa):
     try:
         sa = ifa.ifa_addr.contents
     except ValueError:
-        raise StopIteration()
+        return
     family = sa.sa_family
     addr = None
     if family == socket.AF_INET6:
@@ -89,20 +94,14 @@ def getinfos(ifa):
         yield family, {'address': addr, 'netmask': netmask}
 
 
-def update_inventory(inventory):
-    inventory['fqdn'] = socket.getfqdn()
-    inventory['hostname'] = socket.gethostname()
-
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    s.connect(('example.com', 1))  # connect() for UDP doesn't send packets
-    inet_addr = s.getsockname()[0]
-
+def get_ifaces():
+    """return interfaces and their addresses. Does not use the network"""
     ifap = POINTER(struct_ifaddrs)()
     result = libc.getifaddrs(pointer(ifap))
     if result != 0:
         raise RuntimeError(get_errno())
     families = {2: 'AF_INET', 10: 'AF_INET6'}
-    ifaces = inventory['ifaces'] = {}
+    ifaces = {}
     try:
         for ifa in iter_ifaps(ifap):
             name = ifa.ifa_name.decode('utf8')
@@ -116,8 +115,6 @@ def update_inventory(inventory):
             for family, addr in getinfos(ifa):
                 if addr:
                     family = families[family][3:].lower()
-                    if family == 'inet' and addr['address'] == inet_addr:
-                        d['primary'] = True
                     d.setdefault(family, []).append(addr)
                     filename = '/sys/class/net/{0}/address'.format(name)
                     if os.path.isfile(filename):
@@ -128,6 +125,45 @@ def update_inventory(inventory):
         libc.freeifaddrs(ifap)
 
 
+def get_route_address():
+    """return the source address of the default route. Does not resolve
+    anything nor send packets"""
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        # connect() for UDP doesn't send packets
+        s.connect(('8.8.8.8', 1))
+        return s.getsockname()[0]
+    except (IOError, OSError):
+        return None
+    finally:
+        s.close()
+
+
+def inventory_key():
+    """the cached inventory is outdated when addresses, the default route or
+    resolver files change"""
+    mtimes = [int(os.stat(f).st_mtime * 1000000) if os.path.exists(f) else None
+              for f in _files]
+    addresses = sorted(
+        [name, family, addr['address']]
+        for name, d in get_ifaces().items()
+        for family in ('inet', 'inet6')
+        for addr in d.get(family, []))
+    return [socket.gethostname(), mtimes, addresses, get_route_address()]
+
+
+def update_inventory(inventory):
+    inventory['fqdn'] = socket.getfqdn()
+    inventory['hostname'] = socket.gethostname()
+    inet_addr = get_route_address()
+
+    ifaces = inventory['ifaces'] = get_ifaces()
+    for d in ifaces.values():
+        for addr in d.get('inet', []):
+            if addr['address'] == inet_addr:
+                d['primary'] = True
+
+
 def finalize_inventory(inventory):
     import ipaddress
     ifaces = inventory['ifaces']
@@ -8,6 +8,14 @@ DEBIAN_RELEASES = (
     (u'7.', u'squeeze')
 )
 
+inventory_ttl = 86400
+
+
+def inventory_key():
+    filename = '/etc/debian_version'
+    if os.path.isfile(filename):
+        return int(os.stat(filename).st_mtime * 1000000)
+
 
 def update_inventory(inventory):
     infos = {'name': None, 'version': None, 'release': None}
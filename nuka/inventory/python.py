@@ -8,9 +8,15 @@ def update_inventory(inventory):
         zlib_avalaible = True
     except ImportError:  # pragma: no cover
         zlib_avalaible = False
+    try:
+        import msgpack  # NOQA
+        msgpack_available = True
+    except ImportError:
+        msgpack_available = False
     data = {
         'executable': sys.executable,
         'python_version': list(sys.version_info),
         'zlib_available': zlib_avalaible,
+        'msgpack_available': msgpack_available,
     }
     inventory['python'] = data
@@ -17,11 +17,12 @@
 
 from asyncio import subprocess
 from asyncio import streams
+import collections
+import itertools
 import asyncio
 import random
 import socket
 import time
-import zlib
 import os
 
 import asyncssh
@@ -31,85 +32,90 @@ import nuka
 from nuka import utils
 
 DEFAULT_LIMIT = streams._DEFAULT_LIMIT
+CHUNK_SIZE = 64 * 1024
+# max delay between two attempts to open a session refused by the server
+MAX_CHANNEL_DELAY = 3.2
 
 asyncssh_connections = {}
 asyncssh_connections_tasks = {}
+asyncssh_connecting = {}
+asyncssh_rate = []
 asyncssh_keypairs = []
 asyncssh_known_hosts = []
 
 
+async def send_file(stdin, filename, request_id=None):
+    """stream a file in binary chunks ended by an empty chunk"""
+    with open(filename, 'rb') as fd:
+        chunk = fd.read(CHUNK_SIZE)
+        while chunk:
+            stdin.write(utils.proto_dumps_binary(chunk, request_id))
+            await stdin.drain()
+            chunk = fd.read(CHUNK_SIZE)
+    stdin.write(utils.proto_dumps_binary(b'', request_id))
+    await stdin.drain()
+
+
 class BaseProcess:
 
-    async def send_message(self, message, drain=True):
-        utils.proto_dumps_std(message, self.stdin)
+    async def send_message(self, message, drain=True, content_type='plain'):
+        utils.proto_dumps_std(message, self.stdin, content_type=content_type)
         if drain:
-            return self.stdin.drain()
+            await self.stdin.drain()
+
+    async def send_file(self, filename):
+        await send_file(self.stdin, filename)
 
     async def next_message(self):
+        data = await self.read_message()
+        if data.get('message_type') == 'exit':
+            await self.wait()
+            duration = time.time() - self.start
+            latency = duration - data['meta']['remote_time']
+            self.host.add_time(
+                type='process', cmd=self.cmd,
+                start=self.start, time=duration, latency=latency,
+                task=self.task, meta=data['meta'])
+        return data
+
+    async def read_message(self):
+        content_type = await self.stdout.readline()
+        content_length = await self.stdout.readline()
+        headers = (content_type or b'') + (content_length or b'')
         try:
-            self.read_task = self._loop.create_task(self.stdout.readline())
-            content_type = await self.read_task
-            self.read_task = self._loop.create_task(self.stdout.readline())
-            content_length = await self.read_task
-        except asyncio.CancelledError:
-            raise
-        else:
-            headers = (content_type or b'') + (content_length or b'')
-            self.read_task = None
-            try:
-                if isinstance(content_type, bytes):
-                    content_type = content_type.decode('utf8')
-                content_type = content_type.split(':')[1].strip()
-                if isinstance(content_length, bytes):
-                    content_length = content_length.decode('utf8')
-                content_length = int(content_length.split(':')[1].strip())
-            except IndexError:
-                stdout = await self.stdout.read()
-                if stdout or headers:
-                    print((headers, stdout))
-                stderr = await self.stderr.read()
-                if stderr:
-                    stderr = stderr.decode('utf8')
-                    err = stderr.lower()
-                    exc = OSError
-                    if 'could not resolve hostname' in err:
-                        exc = LookupError
-                    elif 'host key verification failed' in err:
-                        exc = LookupError
-                    elif 'permission denied' in err:
-                        exc = LookupError
-                    exc = exc(stderr, self.host)
-                    if isinstance(exc, LookupError):
-                        self.host.fail(exc)
-                    raise exc
-
-                else:
-                    raise ValueError((content_length, stderr))
-            data = b''
-            while len(data) < content_length:
-                try:
-                    coro = self.stdout.read(content_length - len(data))
-                    self.read_task = self._loop.create_task(coro)
-                    data += await self.read_task
-                except asyncio.CancelledError:
-                    raise
-            if content_type == 'zlib':
-                data = zlib.decompress(data)
-            data = data.decode('utf8')
-            try:
-                data = utils.json.loads(data)
-            except ValueError:
-                raise ValueError(data)
-            self.host.log.debug5(data)
-            if data.get('message_type') == 'exit':
-                await self.wait()
-                duration = time.time() - self.start
-                latency = duration - data['meta']['remote_time']
-                self.host.add_time(
-                    type='process', cmd=self.cmd,
-                    start=self.start, time=duration, latency=latency,
-                    task=self.task, meta=data['meta'])
-            return data
+            if isinstance(content_type, bytes):
+                content_type = content_type.decode('utf8')
+            content_type = content_type.split(':')[1].strip()
+            if isinstance(content_length, bytes):
+                content_length = content_length.decode('utf8')
+            content_length = int(content_length.split(':')[1].strip())
+        except IndexError:
+            stdout = await self.stdout.read()
+            if stdout or headers:
+                print((headers, stdout))
+            stderr = await self.stderr.read()
+            if stderr:
+                stderr = stderr.decode('utf8')
+                err = stderr.lower()
+                exc = OSError
+                if 'could not resolve hostname' in err:
+                    exc = LookupError
+                elif 'host key verification failed' in err:
+                    exc = LookupError
+                elif 'permission denied' in err:
+                    exc = LookupError
+                exc = exc(stderr, self.host)
+                if isinstance(exc, LookupError):
+                    self.host.fail(exc)
+                raise exc
+
+            else:
+                raise ValueError((content_length, stderr))
+        # the body is copied once from the reader's buffer
+        data = await self.stdout.readexactly(content_length)
+        data = utils.proto_loads(data, content_type)
+        self.host.log.debug5(data)
+        return data
 
     async def exit(self):
         if self.returncode is None:
@@ -126,6 +132,104 @@ class BaseProcess:
         self.host._processes.pop(id(self), None)
 
 
+class Agent:
+    """A persistent remote script (started with ``--agent``) running many
+    tasks over a single process. Messages are dispatched to
+    :class:`AgentRequest` using their ``request_id``"""
+
+    def __init__(self, host, proc):
+        self.host = host
+        self.proc = proc
+        self.closed = False
+        # number of requests expected before closing. None means persistent
+        self.pending = None
+        self.requests = {}
+        self.request_ids = itertools.count(1)
+        self.reader = host.loop.create_task(self.dispatch())
+
+    def create_request(self, task):
+        request = AgentRequest(self, next(self.request_ids), task)
+        self.requests[request.request_id] = request
+        return request
+
+    async def dispatch(self):
+        try:
+            while True:
+                data = await self.proc.read_message()
+                request = self.requests.get(data.get('request_id'))
+                if request is None:  # pragma: no cover
+                    self.host.log.debug5('orphan message {0}'.format(data))
+                    continue
+                if data.get('message_type') == 'exit':
+                    self.requests.pop(request.request_id, None)
+                    self.release()
+                request.queue.put_nowait(data)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if not self.closed:
+                self.host.log.exception5('agent')
+            self.close()
+            for request in self.requests.values():
+                request.queue.put_nowait(e)
+            self.requests.clear()
+
+    def release(self):
+        """a request is done (or will never be sent). Close the agent if it
+        was the last one expected"""
+        if self.pending is not None:
+            self.pending -= 1
+            if self.pending <= 0:
+                self.close()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.proc.stdin.close()
+
+    async def wait_closed(self):
+        self.close()
+        await self.reader
+        await self.proc.wait()
+
+
+class AgentRequest:
+    """A task running in an :class:`Agent`. Provide the same interface
+    than a process"""
+
+    def __init__(self, agent, request_id, task):
+        self.agent = agent
+        self.request_id = request_id
+        self.host = agent.host
+        self.task = task
+        self.cmd = agent.proc.cmd
+        self.start = time.time()
+        self.queue = asyncio.Queue(loop=self.host.loop)
+
+    async def send_message(self, message, content_type='plain'):
+        message = dict(message, request_id=self.request_id)
+        utils.proto_dumps_std(message, self.agent.proc.stdin,
+                              content_type=content_type)
+        await self.agent.proc.stdin.drain()
+
+    async def send_file(self, filename):
+        await send_file(self.agent.proc.stdin, filename,
+                        request_id=self.request_id)
+
+    async def next_message(self):
+        data = await self.queue.get()
+        if isinstance(data, Exception):
+            raise data
+        if data.get('message_type') == 'exit':
+            duration = time.time() - self.start
+            latency = duration - data['meta']['remote_time']
+            self.host.add_time(
+                type='process', cmd=self.cmd,
+                start=self.start, time=duration, latency=latency,
+                task=self.task, meta=data['meta'])
+        return data
+
+
 class Process(subprocess.Process, BaseProcess):
 
     def __init__(self, transport, protocol, host, task, cmd, start):
@@ -134,20 +238,25 @@ class Process(subprocess.Process, BaseProcess):
         self.task = task
         self.cmd = cmd
         self.start = start
-        self.read_task = None
 
 
 class SSHClient(asyncssh.SSHClient):
 
     def __init__(self, uid):
         self.uid = uid
+        self.conn = None
         self.start = time.time()
 
-    def connection_made(self, *args, **kwargs):
+    def connection_made(self, conn, *args, **kwargs):
         now = time.time()
+        self.conn = conn
         asyncssh_connections[self.uid]['connect'] = now - self.start
         self.start = now
 
+    def connection_lost(self, exc):
+        # next processes will reconnect
+        drop_connection(self.uid, self.conn)
+
     def auth_completed(self, *args, **kwargs):
         asyncssh_connections[self.uid]['auth_time'] = time.time() - self.start
 
@@ -161,7 +270,6 @@ class SSHClientProcess(asyncssh.SSHClientProcess, BaseProcess):
         self.task = task
         self.cmd = cmd
         self.start = start
-        self.read_task = None
 
     @property
     def returncode(self):
@@ -189,18 +297,166 @@ def get_known_hosts(filename):
     return asyncssh_known_hosts[0]
 
 
-async def delay_connection(uid, loop):
-    if uid not in asyncssh_connections:
-        delay = nuka.config['connections']['delay']
-        now = time.time()
-        asyncssh_connections[uid] = {'now': now, 'timeouts': 0}
+class ConnectionsRate(object):
+    """A token bucket used to open ssh connections. The rate is increased
+    after each successful connection and halved on timeouts or refused
+    connections (AIMD)"""
+
+    def __init__(self, rate, max_rate=None):
+        self.step = rate
+        self.rate = rate
+        self.min_rate = rate / 10.
+        self.max_rate = max(max_rate or rate, rate)
+        self.tokens = 1.
+        self.last = None
+        self.waiters = collections.deque()
+        self.handle = None
+
+    def refill(self, loop):
+        now = loop.time()
+        if self.last is not None:
+            tokens = self.tokens + (now - self.last) * self.rate
+            self.tokens = min(tokens, max(self.rate, 1.))
+        self.last = now
+
+    async def acquire(self, loop):
+        self.refill(loop)
+        if self.tokens >= 1 and not self.waiters:
+            self.tokens -= 1
+            return
+        waiter = asyncio.Future(loop=loop)
+        self.waiters.append(waiter)
+        self.schedule(loop)
+        await waiter
+
+    def schedule(self, loop):
+        if self.handle is None:
+            delay = max((1 - self.tokens) / self.rate, 0)
+            self.handle = loop.call_later(delay, self.wakeup, loop)
+
+    def wakeup(self, loop):
+        self.handle = None
+        self.refill(loop)
+        while self.waiters and self.tokens >= 1:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(True)
+                self.tokens -= 1
+        if self.waiters:
+            self.schedule(loop)
+
+    def increase(self):
+        self.rate = min(self.rate + self.step, self.max_rate)
+
+    def decrease(self):
+        self.rate = max(self.rate / 2., self.min_rate)
+
+
+def get_connections_rate():
+    """return the rate shared by all connections. None if connections are
+    not delayed"""
+    if not asyncssh_rate:
+        config = nuka.config['connections']
+        delay = config['delay']
         if delay:
-            delay = (delay * len(asyncssh_connections))
-            min_time = asyncssh_connections.setdefault('time', now) + delay
-            delay = min_time - now
-            if delay:
-                asyncssh_connections[uid]['delay'] = delay
-                await asyncio.sleep(delay, loop=loop)
+            asyncssh_rate.append(
+                ConnectionsRate(1. / delay, config.get('max_rate')))
+        else:
+            asyncssh_rate.append(None)
+    return asyncssh_rate[0]
+
+
+async def connect(uid, hostname, port, attempts, timeout, **kwargs):
+    """open an asyncssh connection and store it in
+    ``asyncssh_connections``. Return None if the user hit Ctrl+C"""
+    username, host = uid
+    loop = host.loop
+    exc = None
+    client_keys = await get_keys(loop)
+    rate = get_connections_rate()
+    infos = asyncssh_connections.setdefault(
+        uid, {'now': time.time(), 'timeouts': 0, 'refusals': 0})
+
+    for i in range(1, attempts + 1):
+        if rate is not None:
+            start = time.time()
+            asyncssh_connections_tasks[uid] = loop.create_task(
+                rate.acquire(loop))
+            try:
+                await asyncssh_connections_tasks[uid]
+            except asyncio.CancelledError:
+                host.fail(LookupError(OSError('sigint'), host))
+                return
+            infos['delay'] = infos.get('delay', 0) + time.time() - start
+        try:
+            host.log.debug5('open connection {0}/{1} at {2}'.format(
+                            i, attempts, time.time()))
+            if nuka.run_vars['sigint']:
+                exc = LookupError(OSError('sigint'), host)
+                break
+            asyncssh_connections_tasks[uid] = loop.create_task(
+                asyncssh.create_connection(
+                    lambda: SSHClient(uid),
+                    hostname, port,
+                    username=username,
+                    client_keys=client_keys,
+                    loop=loop,
+                    **kwargs
+                    )
+                )
+            conn, client = await asyncio.wait_for(
+                    asyncssh_connections_tasks[uid],
+                    timeout=timeout, loop=loop)
+            break
+        except asyncio.CancelledError as e:
+            exc = LookupError(OSError('sigint'), host)
+            break
+        except asyncio.TimeoutError as e:
+            infos['timeouts'] += 1
+            if i == attempts:
+                host.log.error('TimeoutError({0}) exceeded '.format(
+                    timeout, i, attempts))
+                exc = LookupError(e, host)
+                break
+        except (asyncssh.DisconnectError, ConnectionResetError) as e:
+            code = getattr(e, 'code', asyncssh.DISC_CONNECTION_LOST)
+            if code != asyncssh.DISC_CONNECTION_LOST or i == attempts:
+                exc = LookupError(e, host)
+                break
+            # the server closed the connection before the handshake. this
+            # is how sshd's MaxStartups refuse connections
+            infos['refusals'] += 1
+        except (OSError, socket.error) as e:
+            exc = LookupError(e, host)
+            break
+
+        if rate is not None:
+            rate.decrease()
+        asyncssh_connections_tasks[uid] = loop.create_task(
+            asyncio.sleep(1 + random.random(), loop=loop)
+        )
+        try:
+            await asyncssh_connections_tasks[uid]
+        except asyncio.CancelledError as e:
+            exc = LookupError(e, host)
+            break
+
+    if exc is not None:
+        host.fail(exc)
+        raise exc
+
+    if rate is not None:
+        rate.increase()
+    infos['conn'] = conn
+    return conn
+
+
+def drop_connection(uid, conn):
+    """forget a dropped connection so the next process reconnect"""
+    infos = asyncssh_connections.get(uid, {})
+    if infos.get('conn') is conn:
+        del infos['conn']
+        infos['reconnections'] = infos.get('reconnections', 0) + 1
 
 
 async def create(cmd, host, task=None):
@@ -214,7 +470,7 @@ async def create(cmd, host, task=None):
             return subprocess.SubprocessStreamProtocol(
                 loop=loop, limit=DEFAULT_LIMIT)
 
-        await host.acquire_session_slot()
+        await host.acquire_session_slot(task)
         transport, protocol = await loop.subprocess_exec(
             protocol_factory,
             *cmd,
@@ -237,6 +493,7 @@ async def create(cmd, host, task=None):
         known_hosts = ()
         attempts = 1
         timeout = 924  # Default TCP Timeout on debian
+        keepalive = {}
         while tmp_cmd:
             v = tmp_cmd.pop(0)
             if v == '-l':
@@ -251,6 +508,12 @@ async def create(cmd, host, task=None):
                 attempts = int(v.split('=', 1)[1].strip())
             elif v.startswith('-oConnectTimeout'):
                 timeout = int(v.split('=', 1)[1].strip())
+            elif v.startswith('-oServerAliveInterval'):
+                keepalive['keepalive_interval'] = int(
+                    v.split('=', 1)[1].strip())
+            elif v.startswith('-oServerAliveCountMax'):
+                keepalive['keepalive_count_max'] = int(
+                    v.split('=', 1)[1].strip())
 
         if known_hosts is not None:
             filename = os.path.expanduser('~/.ssh/known_hosts')
@@ -264,73 +527,47 @@ async def create(cmd, host, task=None):
                     return
 
         uid = (username, host)
-        conn = asyncssh_connections.get(uid, {}).get('conn')
-        if conn is None:
-            exc = None
-            client_keys = await get_keys(loop)
-            asyncssh_connections_tasks[uid] = loop.create_task(
-                delay_connection(uid, loop)
-            )
+        reconnect = True
+        delay = .1
+        while True:
+            conn = asyncssh_connections.get(uid, {}).get('conn')
+            if conn is None:
+                # share the connection attempt with concurrent processes
+                connecting = asyncssh_connecting.get(uid)
+                if connecting is None:
+                    connecting = asyncssh_connecting[uid] = loop.create_task(
+                        connect(uid, hostname, int(port), attempts, timeout,
+                                known_hosts=known_hosts,
+                                agent_forwarding=agent_forwarding,
+                                **keepalive))
+                    connecting.add_done_callback(
+                        lambda f: asyncssh_connecting.pop(uid, None))
+                conn = await asyncio.shield(connecting, loop=loop)
+                if conn is None:
+                    return
+            await host.acquire_session_slot(task)
             try:
-                await asyncssh_connections_tasks[uid]
-            except asyncio.CancelledError as e:
-                exc = LookupError(OSError('sigint'), host)
-                host.fail(exc)
-                return
-
-            for i in range(1, attempts + 1):
-                host.log.debug5('open connection {0}/{1} at {2}'.format(
-                                i, attempts, time.time()))
-                try:
-                    if nuka.run_vars['sigint']:
-                        exc = LookupError(OSError('sigint'), host)
-                        break
-                    asyncssh_connections_tasks[uid] = loop.create_task(
-                        asyncssh.create_connection(
-                            lambda: SSHClient(uid),
-                            hostname, int(port),
-                            username=username,
-                            known_hosts=known_hosts,
-                            agent_forwarding=agent_forwarding,
-                            client_keys=client_keys,
-                            loop=loop,
-                            )
-                        )
-                    conn, client = await asyncio.wait_for(
-                            asyncssh_connections_tasks[uid],
-                            timeout=timeout, loop=loop)
-                    break
-                except asyncio.CancelledError as e:
-                    exc = LookupError(OSError('sigint'), host)
-                    break
-                except asyncio.TimeoutError as e:
-                    timeouts = asyncssh_connections[uid]['timeouts']
-                    asyncssh_connections[uid]['timeouts'] = timeouts + 1
-                    if i == attempts:
-                        host.log.error('TimeoutError({0}) exceeded '.format(
-                            timeout, i, attempts))
-                        exc = LookupError(e, host)
-                    else:
-                        asyncssh_connections_tasks[uid] = loop.create_task(
-                            asyncio.sleep(1 + random.random(), loop=loop)
-                        )
-                        try:
-                            await asyncssh_connections_tasks[uid]
-                        except asyncio.CancelledError as e:
-                            exc = LookupError(e, host)
-                            break
-                except (OSError, socket.error) as e:
-                    exc = LookupError(e, host)
-                    break
-
-            if exc is not None:
-                host.fail(exc)
-                raise exc
-
-            asyncssh_connections[uid]['conn'] = conn
-        await host.acquire_session_slot()
-        chan, proc = await conn.create_session(
-                protocol_factory, ssh_cmd, encoding=None)
+                chan, proc = await conn.create_session(
+                        protocol_factory, ssh_cmd, encoding=None)
+            except asyncssh.ChannelOpenError as e:
+                # the server refused the session (sshd's MaxSessions). wait
+                # for a session of the connection to end
+                host.free_session_slot()
+                if delay > MAX_CHANNEL_DELAY:
+                    raise
+                host.log.debug5('retry in {0}s after {1!r}'.format(delay, e))
+                await asyncio.sleep(delay, loop=loop)
+                delay *= 2
+            except (asyncssh.DisconnectError, OSError) as e:
+                # the connection was dropped. reconnect once
+                host.free_session_slot()
+                drop_connection(uid, conn)
+                if not reconnect:
+                    raise
+                reconnect = False
+                host.log.debug5('reconnect after {0!r}'.format(e))
+            else:
+                break
         await proc.redirect(asyncssh.PIPE, asyncssh.PIPE, asyncssh.PIPE,
                             DEFAULT_LIMIT)
     host._processes[id(proc)] = proc
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import tarfile
+import hashlib
 import time
 import sys
 import os
@@ -7,72 +8,120 @@ import io
 
 import nuka
 
+# bump when the archive layout change so cached archives are rebuilt
+ARCHIVE_FORMAT = 2
+
+# the script run on the remote host. The code live in nuka/script.py so it
+# is byte-compiled like the other modules during setup
+SCRIPT = b"""# -*- coding: utf-8 -*-
+from nuka.script import run
+run()
+"""
+
 
 def exclude_pyc(info):
     if info.name.endswith(('.py', 'tasks', 'inventory')):
         return info
 
 
+def archive_files(extra_classes=[]):
+    """return the list of ``(src, dst)`` files to put in the archive and the
+    list of directories which need an empty ``__init__.py``"""
+    modules = nuka.config['inventory_modules'][:]
+    modules.extend([klass.__module__ for klass in extra_classes])
+
+    dirnames = set()
+    filenames = set()
+    for module in modules:
+        if module.startswith('nuka.'):
+            continue
+        mod = sys.modules[module]
+        mod_path = module.replace('.', '/') + '.py'
+        filenames.add((mod.__file__, mod_path))
+        dirname = mod_path
+        while os.sep in dirname:
+            dirname = os.path.dirname(dirname)
+            dirnames.add(dirname)
+
+    nuka_dir = os.path.dirname(nuka.__file__)
+    for name in ('inventory', 'tasks'):
+        dirname = os.path.join(nuka_dir, name)
+        for filename in sorted(os.listdir(dirname)):
+            if filename.endswith('.py'):
+                filenames.add((os.path.join(dirname, filename),
+                               'nuka/{0}/{1}'.format(name, filename)))
+    filenames.add((os.path.join(nuka_dir, 'remote/task.py'), 'nuka/task.py'))
+    filenames.add((os.path.join(nuka_dir, 'utils.py'), 'nuka/utils.py'))
+    filenames.add((os.path.join(nuka_dir, 'remote/script.py'),
+                   'nuka/script.py'))
+    return sorted(filenames), sorted(dirnames)
+
+
+def archive_key(filenames, mode):
+    """return a key identifying the archive content without building it"""
+    h = hashlib.sha1(mode.encode('utf8'))
+    h.update('format:{0}\n'.format(ARCHIVE_FORMAT).encode('utf8'))
+    h.update(SCRIPT)
+    for src, dst in filenames:
+        st = os.stat(src)
+        h.update('{0}:{1}:{2}\n'.format(dst, st.st_mtime, st.st_size).encode(
+            'utf8'))
+    return h.hexdigest()
+
+
 def build_archive(extra_classes=[], mode='x:gz'):
-    """build a tarball with required scripts and python modules"""
+    """build a tarball with required scripts and python modules. The archive
+    is cached in ``nuka_dir`` so its digest is stable between runs"""
     try:
         return build_archive.archives[mode]
     except KeyError:
+        filenames, dirnames = archive_files(extra_classes)
+
+        cache_dir = os.path.join(nuka.config['nuka_dir'], 'archives')
+        cache = os.path.join(cache_dir, '{0}.tar.{1}'.format(
+            archive_key(filenames, mode), mode.split(':')[-1]))
+        if os.path.isfile(cache):
+            with open(cache, 'rb') as fd:
+                data = fd.read()
+        else:
+            data = _build_archive(filenames, dirnames, mode)
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            with open(cache + '.tmp', 'wb') as fd:
+                fd.write(data)
+            os.rename(cache + '.tmp', cache)
 
-        modules = nuka.config['inventory_modules'][:]
-        modules.extend([klass.__module__ for klass in extra_classes])
-
-        dirnames = set()
-        filenames = set()
-        for module in modules:
-            if module.startswith('nuka.'):
-                continue
-            mod = sys.modules[module]
-            mod_path = module.replace('.', '/') + '.py'
-            filenames.add((mod.__file__, mod_path))
-            dirname = mod_path
-            while os.sep in dirname:
-                dirname = os.path.dirname(mod_path)
-                dirnames.add(dirname)
-
-        nuka_dir = os.path.dirname(nuka.__file__)
-        fd = io.BytesIO()
-        with tarfile.open(fileobj=fd, mode=mode) as tfd:
-            for dirname in dirnames:
-                filename = dirname + '/__init__.py'
-                if filename not in filenames:
-                    tarinfo = tarfile.TarInfo(name=filename)
-                    tarinfo.size = len(b'')
-                    tarinfo.mtime = time.time()
-                    tfd.addfile(tarinfo, io.BytesIO(b''))
-            for src, dst in filenames:
-                tfd.add(src, dst)
-            tfd.add(os.path.join(nuka_dir, 'inventory'),
-                    'nuka/inventory', filter=exclude_pyc)
-            tfd.add(os.path.join(nuka_dir, 'tasks'),
-                    'nuka/tasks', filter=exclude_pyc)
-            tfd.add(os.path.join(nuka_dir, 'remote/task.py'),
-                    'nuka/task.py')
-            tarinfo = tarfile.TarInfo(name='nuka/__init__.py')
-            tarinfo.size = len(b'')
-            tarinfo.mtime = time.time()
-            tfd.addfile(tarinfo, io.BytesIO(b''))
-            tfd.add(os.path.join(nuka_dir, 'utils.py'),
-                    'nuka/utils.py')
-            tfd.add(os.path.join(nuka_dir, 'remote/script.py'),
-                    'script.py')
-
-            filenames = tfd.getnames()
-
-        fd.seek(0)
-        build_archive.archives[mode] = fd.read()
+        build_archive.archives[mode] = data
+        build_archive.digests[mode] = hashlib.sha1(data).hexdigest()
 
         if nuka.cli.args.verbose > 6:
             print('tarfile({0}ko): \n - {1}'.format(
-                int(len(build_archive.archives[mode]) / 1024),
-                '\n - '.join(filenames)))
+                int(len(data) / 1024),
+                '\n - '.join([dst for src, dst in filenames])))
 
         return build_archive.archives[mode]
 
 
 build_archive.archives = {}
+build_archive.digests = {}
+
+
+def _build_archive(filenames, dirnames, mode):
+    fd = io.BytesIO()
+    with tarfile.open(fileobj=fd, mode=mode) as tfd:
+        dsts = [dst for src, dst in filenames]
+        for dirname in dirnames + ['nuka']:
+            filename = dirname + '/__init__.py'
+            if filename not in dsts:
+                tarinfo = tarfile.TarInfo(name=filename)
+                tarinfo.size = len(b'')
+                tarinfo.mtime = time.time()
+                tfd.addfile(tarinfo, io.BytesIO(b''))
+        tarinfo = tarfile.TarInfo(name='script.py')
+        tarinfo.size = len(SCRIPT)
+        tarinfo.mtime = time.time()
+        tfd.addfile(tarinfo, io.BytesIO(SCRIPT))
+        for src, dst in filenames:
+            tfd.add(src, dst, filter=exclude_pyc)
+    fd.seek(0)
+    return fd.read()
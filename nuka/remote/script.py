@@ -18,6 +18,9 @@
 
 import os
 import sys
+import time
+import errno
+import select
 import signal
 import logging
 import tempfile
@@ -37,6 +40,7 @@ def main(data=None):
         if 'environ' in data:
             os.environ.update(data['environ'])
         tempfile.tempdir = data['remote_tmp']
+        Task.content_type = data.get('content_type')
 
         logging.basicConfig(
             format='%(levelname)s:%(message)s',
@@ -54,9 +58,10 @@ def main(data=None):
         res = dict(rc=1, exc=Task.format_exception())
         Task.exit(res)
 
-    # clean exit on SIGINT
-    signal.signal(signal.SIGALRM, task.on_alarm)
-    signal.alarm(task.alarm_delay)
+    # clean exit on SIGINT. the watching thread use SIGUSR1 to run
+    # on_sigint in the main thread
+    signal.signal(signal.SIGUSR1, task.on_sigint)
+    task.start_watching()
 
     if data['diff_mode']:
         meth_name = 'diff'
@@ -75,9 +80,156 @@ def main(data=None):
         res = meth() or {}
     except Exception:
         res = dict(rc=1, exc=task.format_exception())
+    else:
+        if data.get('fingerprints') and res.get('rc') == 0:
+            # the client may skip the task next time if nothing change
+            res['fingerprints'] = utils.fingerprints(data['fingerprints'])
     task.exit(res)
 
 
+class Worker(object):
+    """A forked child running one task for the agent"""
+
+    def __init__(self, request_id, pid, stdin, stdout, content_type=None):
+        self.request_id = request_id
+        self.content_type = content_type
+        self.pid = pid
+        self.stdin = stdin
+        self.stdout = stdout
+        self.buffer = b''
+        self.exited = False
+
+
+def write_all(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def fork_worker(request_id, message, workers, content_type=None):
+    in_r, in_w = os.pipe()
+    out_r, out_w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # child: use the pipes as stdin/stdout and run the task as if we
+        # were a fresh script
+        code = 0
+        try:
+            os.dup2(in_r, 0)
+            os.dup2(out_w, 1)
+            for fd in (in_r, in_w, out_r, out_w):
+                os.close(fd)
+            for worker in workers.values():
+                os.close(worker.stdin)
+                os.close(worker.stdout)
+            # read stdin unbuffered so control messages sent after the
+            # task are still visible to select() in Task.watch
+            Task.stdin = os.fdopen(0, 'rb', 0)
+            Task.remote_start = time.time()
+            main()
+        except SystemExit as e:
+            code = e.code or 0
+        except BaseException:
+            code = 1
+            sys.stderr.write(''.join(Task.format_exception()))
+        finally:
+            sys.stdout.flush()
+            os._exit(code)
+    os.close(in_r)
+    os.close(out_w)
+    worker = Worker(request_id, pid, in_w, out_r, content_type)
+    write_all(in_w, message)
+    return worker
+
+
+def agent():
+    """run as a persistent process. Each request read on stdin is run in a
+    forked child (so modules are imported once) and messages sent by
+    children are relayed to stdout with their request_id"""
+    content_type = utils.zlib is None and u'plain' or u'zlib'
+    workers = {}
+    buffer = b''
+    stdin_closed = False
+
+    while workers or not stdin_closed:
+        fds = list(workers)
+        if not stdin_closed:
+            fds.append(0)
+        try:
+            ready = select.select(fds, [], [])[0]
+        except (select.error, OSError) as e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        for fd in ready:
+            data = os.read(fd, 65536)
+            if fd == 0:
+                if not data:
+                    stdin_closed = True
+                    continue
+                buffer += data
+                while True:
+                    message, buffer = utils.proto_split(buffer)
+                    if message is None:
+                        break
+                    data = utils.proto_loads_std(message)
+                    if isinstance(data, bytes):
+                        # a chunk of a streamed file
+                        request_id = utils.proto_params(message).get(
+                            'request_id')
+                        for worker in workers.values():
+                            if str(worker.request_id) == request_id:
+                                write_all(worker.stdin, message)
+                        continue
+                    request_id = data.get('request_id')
+                    if 'task' in data:
+                        try:
+                            # import the module once in the agent so
+                            # children do not have to
+                            utils.import_module(data['task'][0])
+                        except Exception:
+                            pass
+                        worker = fork_worker(
+                            request_id, message, workers,
+                            data.get('content_type', content_type))
+                        workers[worker.stdout] = worker
+                    else:
+                        # control message. eg: signal
+                        for worker in list(workers.values()):
+                            if request_id in (None, worker.request_id):
+                                try:
+                                    write_all(worker.stdin, message)
+                                except OSError:
+                                    pass
+                continue
+            worker = workers[fd]
+            if data:
+                worker.buffer += data
+                while True:
+                    message, worker.buffer = utils.proto_split(worker.buffer)
+                    if message is None:
+                        break
+                    data = utils.proto_loads_std(message)
+                    data['request_id'] = worker.request_id
+                    if data.get('message_type') == 'exit':
+                        worker.exited = True
+                    write_all(1, utils.proto_dumps(
+                        data, content_type=worker.content_type))
+            else:
+                # child is done
+                del workers[fd]
+                os.close(worker.stdin)
+                os.close(worker.stdout)
+                status = os.waitpid(worker.pid, 0)[1]
+                if not worker.exited:
+                    res = dict(
+                        rc=1, message_type='exit', signal=None,
+                        request_id=worker.request_id,
+                        stderr='worker exited with status {0}'.format(status),
+                        meta=dict(remote_calls=[], remote_time=0.))
+                    write_all(1, utils.proto_dumps(
+                        res, content_type=worker.content_type))
+
+
 def setup():
 
     logging.basicConfig(
@@ -99,6 +251,8 @@ def setup():
         if os.path.isfile(python) and sys.executable != python:
             os.execv(python, [python] + sys.argv)
 
+    compile_modules()
+
     # launch setup task
     main(data=dict(
         task=('nuka.tasks.setup', 'setup'),
@@ -108,8 +262,29 @@ def setup():
     )
 
 
-if __name__ == '__main__':
+def compile_modules():
+    """byte-compile the remote tree with the python used to run tasks so
+    each task process only load ``.pyc`` files"""
+    import compileall
+    dirname = os.path.abspath(os.path.dirname(sys.argv[0]))
+    try:
+        compileall.compile_dir(os.path.join(dirname, 'nuka'), quiet=1)
+    except Exception:
+        # tasks will still run from the .py files
+        pass
+
+
+def run():
     if '--setup' in sys.argv:
         setup()
+    elif '--agent' in sys.argv:
+        agent()
     else:
+        # read stdin unbuffered so control messages sent after the task
+        # are still visible to select() in Task.watch
+        Task.stdin = os.fdopen(0, 'rb', 0)
         main()
+
+
+if __name__ == '__main__':
+    run()
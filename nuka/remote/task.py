@@ -19,12 +19,16 @@ from __future__ import unicode_literals
 import os
 import sys
 import time
+import errno
 import codecs
 import signal
 import select
 import difflib
 import logging
+import tempfile
+import threading
 import subprocess
+import collections
 
 from nuka import utils
 
@@ -39,6 +43,109 @@ def safe_iterator(iterator=None):
         yield
 
 
+class Output(object):
+    """capture a process output. ``mode`` is ``tail`` (only keep the last
+    ``size`` bytes), ``stream`` (tail + send lines to the client as log
+    messages) or ``spool`` (tail + write the whole output to a temporary
+    file)"""
+
+    modes = ('tail', 'stream', 'spool')
+
+    def __init__(self, task, name, mode, size):
+        self.task = task
+        self.name = name
+        self.mode = mode
+        self.size = size
+        self.chunks = collections.deque()
+        self.length = 0
+        self.line = b''
+        self.filename = None
+        self.spool = None
+        if mode == 'spool':
+            fd, self.filename = tempfile.mkstemp(prefix=name + '-')
+            self.spool = os.fdopen(fd, 'wb')
+
+    def write(self, chunk):
+        if self.spool is not None:
+            self.spool.write(chunk)
+        elif self.mode == 'stream':
+            lines = (self.line + chunk).split(b'\n')
+            self.line = lines.pop()
+            if lines:
+                self.send(lines)
+        self.chunks.append(chunk)
+        self.length += len(chunk)
+        while self.length - len(self.chunks[0]) >= self.size:
+            self.length -= len(self.chunks.popleft())
+
+    def send(self, lines):
+        lines = b'\n'.join(lines).decode('utf8', 'replace')
+        self.task.send_log('{0}: {1}'.format(self.name, lines),
+                           level=logging.INFO)
+
+    def close(self):
+        if self.spool is not None:
+            self.spool.close()
+        elif self.line:
+            self.send([self.line])
+
+    def getvalue(self):
+        data = b''.join(self.chunks)[-self.size:]
+        return data.decode('utf8', 'replace')
+
+
+def tail(value, size):
+    """return the last ``size`` bytes of a text. A truncated character is
+    dropped"""
+    data = value.encode('utf8')
+    if len(data) <= size:
+        return value
+    return data[-size:].decode('utf8', 'ignore')
+
+
+def communicate(p, stdin, outputs):
+    """like ``Popen.communicate()`` but write outputs to :class:`Output`
+    instances as soon as they are read"""
+    readers = {}
+    for name in ('stdout', 'stderr'):
+        pipe = getattr(p, name)
+        if pipe is not None:
+            readers[pipe.fileno()] = (pipe, outputs[name])
+    writers = []
+    if p.stdin is not None:
+        if stdin:
+            writers.append(p.stdin.fileno())
+        else:
+            p.stdin.close()
+    offset = 0
+    while readers or writers:
+        try:
+            ready_r, ready_w = select.select(list(readers), writers, [])[:2]
+            for fd in ready_w:
+                try:
+                    offset += os.write(fd, stdin[offset:offset + 512])
+                except OSError as e:
+                    if e.errno != errno.EPIPE:
+                        raise
+                    offset = len(stdin)
+                if offset >= len(stdin):
+                    p.stdin.close()
+                    writers = []
+            for fd in ready_r:
+                chunk = os.read(fd, 65536)
+                if chunk:
+                    readers[fd][1].write(chunk)
+                else:
+                    readers.pop(fd)[0].close()
+        except (select.error, OSError, IOError) as e:
+            # interrupted by a signal
+            if e.args[0] != errno.EINTR:
+                raise
+    for output in outputs.values():
+        output.close()
+    p.wait()
+
+
 class RemoteTask(object):
 
     stdin = getattr(sys.stdin, 'buffer', sys.stdin)
@@ -64,14 +171,23 @@ class Task(RemoteTask):
     current_process = None
     current_cmd = None
 
-    process_watcher_delay = 2
+    # seconds between two steps of the current process watcher
+    watcher_delay = .5
+    watcher_lock = threading.Lock()
 
-    alarm_delay = 1
-    alarm_count = 0
+    # held by the main thread while it reads stdin
+    stdin_lock = threading.Lock()
 
     remote_start = time.time()
     remote_calls = []
 
+    # max size (in bytes) of the outputs kept in remote_calls and by
+    # sh(output=...)
+    output_tail = 8192
+
+    # content type of messages sent to the client. set by the request
+    content_type = None
+
     stds = dict(
         stdin=subprocess.PIPE,
         stdout=subprocess.PIPE,
@@ -125,8 +241,12 @@ class Task(RemoteTask):
 
     @classmethod
     def sh(self, args, stdin=b'', shell=False, env=None, check=True,
-           watcher=None, short_args=None, stdout=None, stderr=None):
-        """run a shell command"""
+           watcher=None, short_args=None, stdout=None, stderr=None,
+           output=None):
+        """run a shell command. The whole output is returned unless
+        ``output`` is set. See :class:`Output`"""
+        if output is not None and output not in Output.modes:
+            raise ValueError(output)
         start = time.time()
         env_ = os.environ.copy()
         env_.update(LC_ALL='C', LANG='C')
@@ -152,9 +272,24 @@ class Task(RemoteTask):
                 self.current_process_watcher = safe_iterator()
             if stdin and not isinstance(stdin, bytes):
                 stdin = stdin.encode('utf8')
-            stdout, stderr = p.communicate(stdin)
+            if output is None:
+                stdout, stderr = p.communicate(stdin)
+            else:
+                outputs = dict(
+                    (name, Output(self, name, output, self.output_tail))
+                    for name in ('stdout', 'stderr')
+                    if kwargs[name] is subprocess.PIPE)
+                communicate(p, stdin, outputs)
+                stdout = stderr = None
+                if 'stdout' in outputs:
+                    stdout = outputs['stdout'].getvalue()
+                if 'stderr' in outputs:
+                    stderr = outputs['stderr'].getvalue()
+                for name, value in outputs.items():
+                    if value.filename:
+                        res[name + '_file'] = value.filename
             self.current_process = None
-            utils._next(self.current_process_watcher)
+            self.step_watcher()
             self.current_process_watcher = None
             if stdout is None:
                 stdout = kwargs['stdout']
@@ -178,8 +313,11 @@ class Task(RemoteTask):
             res.update(rc=rc, stdout=stdout, stderr=stderr)
             exc = None
         t = time.time() - start
-        self.remote_calls.append(dict(res, cmd=args, start=start, time=t,
-                                      exc=exc))
+        call = dict(res, cmd=args, start=start, time=t, exc=exc)
+        for name in ('stdout', 'stderr'):
+            # do not send the whole output twice
+            call[name] = tail(call[name], self.output_tail)
+        self.remote_calls.append(call)
         if check:
             return self.check(res)
         return res
@@ -192,22 +330,69 @@ class Task(RemoteTask):
                                           exc_traceback)
 
     @classmethod
-    def on_alarm(self, *args):
-        self.alarm_count += 1
-        ready = select.select([sys.stdin], [], [], .0)[0]
-        if ready:
+    def start_watching(self):
+        """start a thread to handle the client's control messages as soon
+        as they are received and to step the current process watcher"""
+        thread = threading.Thread(target=self.watch)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    @classmethod
+    def watch(self):
+        fd = self.stdin.fileno()
+        watch_stdin = True
+        next_step = time.time() + self.watcher_delay
+        while True:
+            timeout = max(next_step - time.time(), 0)
+            ready = []
             try:
-                data = utils.proto_loads_std(self.stdin)
-            except ValueError:
+                if watch_stdin:
+                    ready = select.select([fd], [], [], timeout)[0]
+                else:
+                    time.sleep(timeout)
+            except (select.error, OSError) as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+            if ready:
+                with self.stdin_lock:
+                    # the main thread may have read the message
+                    if select.select([fd], [], [], 0)[0]:
+                        try:
+                            data = utils.proto_loads_std(self.stdin)
+                        except ValueError:
+                            # stdin is closed
+                            watch_stdin = False
+                        else:
+                            if isinstance(data, dict) and \
+                               data.get('signal') is not None:
+                                self.interrupt()
+                                return
+            if time.time() >= next_step:
+                next_step = time.time() + self.watcher_delay
+                self.step_watcher()
+
+    @classmethod
+    def interrupt(self):
+        """called by the watching thread when the client send a signal"""
+        if self.current_process is not None:
+            # do not wait for the main thread
+            try:
+                self.current_process.send_signal(signal.SIGINT)
+            except OSError:
                 pass
-            else:
-                sig = data.get('signal')
-                if sig is not None:
-                    self.on_sigint()
-        if self.alarm_count % self.process_watcher_delay == 0:
-            if self.current_process_watcher is not None:
-                utils._next(self.current_process_watcher)
-        signal.alarm(self.alarm_delay)
+        # run on_sigint in the main thread
+        os.kill(os.getpid(), signal.SIGUSR1)
+
+    @classmethod
+    def step_watcher(self):
+        """step the current process watcher unless it's already running"""
+        watcher = self.current_process_watcher
+        if watcher is not None and self.watcher_lock.acquire(False):
+            try:
+                utils._next(watcher)
+            finally:
+                self.watcher_lock.release()
 
     @classmethod
     def on_sigint(self, *args):
@@ -219,7 +404,7 @@ class Task(RemoteTask):
             # let the watcher know that we no longer have a process
             if self.current_process_watcher is not None:
                 self.current_process = None
-                utils._next(self.current_process_watcher)
+                self.step_watcher()
             p.wait()
             res['current_process'] = {
                 'cmd': self.current_cmd,
@@ -257,15 +442,54 @@ class Task(RemoteTask):
         if 'message_type' not in message:
             raise ValueError(
                 'No message_type specified in {0}'.format(message))
-        utils.proto_dumps_std_threadsafe(message, sys.stdout)
+        utils.proto_dumps_std_threadsafe(message, sys.stdout,
+                                         content_type=self.content_type)
         sys.stdout.flush()
 
+    @classmethod
+    def query(self, **kwargs):
+        """send a query to the client and wait for the reply built by the
+        task's ``reply()`` method on the client side"""
+        # the watching thread must not read the reply
+        with self.stdin_lock:
+            self.send_message(dict(kwargs, message_type='query'))
+            while True:
+                data = utils.proto_loads_std(self.stdin)
+                if data.get('signal') is not None:
+                    self.on_sigint()
+                elif data.get('message_type') == 'reply':
+                    break
+            # streamed files are stored in temporary files
+            data['streams'] = [
+                self.recv_stream() for i in range(data.get('streams', 0))]
+            return data
+
+    @classmethod
+    def recv_stream(self):
+        """read a file streamed by the client. return a temporary
+        filename"""
+        fd, filename = tempfile.mkstemp()
+        try:
+            while True:
+                chunk = utils.proto_loads_std(self.stdin)
+                if isinstance(chunk, dict):
+                    if chunk.get('signal') is not None:
+                        self.on_sigint()
+                    continue
+                if not chunk:
+                    break
+                while chunk:
+                    chunk = chunk[os.write(fd, chunk):]
+        finally:
+            os.close(fd)
+        return filename
+
     @classmethod
     def exit(self, res):
         # tel the watcher that the process is ended
         if self.current_process_watcher is not None:
             self.current_process = None
-            utils._next(self.current_process_watcher)
+            self.step_watcher()
         res.setdefault('rc', 0)
         res.setdefault('message_type', 'exit')
         res.setdefault('signal', None)
@@ -279,7 +503,8 @@ class Task(RemoteTask):
             res['log'] = logs
         if 'diff' in res:
             res.setdefault('changed', bool(res['diff']))
-        utils.proto_dumps_std_threadsafe(res, sys.stdout)
+        utils.proto_dumps_std_threadsafe(res, sys.stdout,
+                                         content_type=self.content_type)
         sys.exit(0)
 
     @classmethod
@@ -18,7 +18,8 @@
 import time
 import base64
 import codecs
-import inspect
+import sys
+import os
 import asyncio
 import logging
 import importlib
@@ -44,33 +45,39 @@ class Base(asyncio.Future):
             self.process()
 
     def initialize(self, host=None,
-                   switch_user=None, switch_ssh_user=None, **args):
+                   switch_user=None, switch_ssh_user=None, priority=0,
+                   **args):
         meta = {'filename': None, 'lineno': None,
                 'start': time.time(), 'times': [],
                 'remote_calls': [],
                 }
-        for infos in inspect.stack(2):
-            f = infos.frame
-            if isinstance(f.f_locals.get('self'), RemoteTask):
+        # walk frames. inspect.stack() is too slow since it read sources
+        f = sys._getframe()
+        while f is not None:
+            f_locals = f.f_locals
+            if isinstance(f_locals.get('self'), RemoteTask):
+                f = f.f_back
                 continue
             if host is None:
-                host = f.f_locals.get('host')
+                host = f_locals.get('host')
             if switch_user is None:
-                switch_user = f.f_locals.get('switch_user')
+                switch_user = f_locals.get('switch_user')
             if switch_ssh_user is None:
-                switch_ssh_user = f.f_locals.get('switch_ssh_user')
+                switch_ssh_user = f_locals.get('switch_ssh_user')
             if meta['filename'] is None:
-                filename = infos.filename
+                filename = f.f_code.co_filename
                 if filename.endswith('nuka/task.py'):
                     filename = 'nuka/task.py'
                 meta.update(filename=filename,
-                            lineno=infos.lineno)
+                            lineno=f.f_lineno)
                 if host is not None:
                     break
+            f = f.f_back
         if host is None:  # pragma: no cover
             raise RuntimeError('No valid host found in the stack')
         self.switch_user = switch_user
         self.switch_ssh_user = switch_ssh_user
+        self.priority = priority
         self.meta = meta
         self.host = host
         self.loop = self.host.loop
@@ -121,9 +128,7 @@ class Base(asyncio.Future):
         src = fd['src']
         ctx = dict(self.args, **self.args.get('ctx', {}))
         ctx.update(host=self.host, env=config, **fd)
-        engine = config.get_template_engine()
-        template = engine.get_template(src)
-        fd['data'] = template.render(ctx)
+        fd['data'] = config.render_template(src, ctx)
         if 'executable' not in fd:
             fd['executable'] = utils.isexecutable(src)
 
@@ -233,6 +238,12 @@ class Base(asyncio.Future):
 
 class Task(Base, RemoteTask):
 
+    # True if the task never change anything on the host
+    read_only = False
+
+    # tasks running in this one. see merge()
+    merged = ()
+
     def process(self):
         if self.host.cancelled():
             self.cancel()
@@ -250,13 +261,26 @@ class Task(Base, RemoteTask):
                         self.host.log.warning("{0}.diff is None".format(self))
                     self.set_result(self)
                     return
-            if self.host.fully_booted.done():
+            filenames = [f for f in self.encrypted_files()
+                         if not gpg.is_cached(f)]
+            if self.host.fully_booted.done() and not filenames:
                 super().process()
             else:
                 # use asyncio with callback since we are in a sync __init__
-                task = self.loop.create_task(wait_for_boot(self.host))
+                task = self.loop.create_task(
+                    wait_for_boot(self.host, filenames))
                 task.add_done_callback(super().process)
 
+    def encrypted_files(self):
+        """return the gpg files used by the task. They are decrypted in the
+        loop's executor before :meth:`pre_process`"""
+        filenames = []
+        for fd in self.args.get('files') or ():
+            src = fd.get('src') if isinstance(fd, dict) else None
+            if src and src.endswith('.gpg'):
+                filenames.append(os.path.expanduser(src))
+        return filenames
+
     async def run(self):
         """Serialize the task, send it to the remote host.
         The remote script will deserialize the task and run
@@ -266,6 +290,17 @@ class Task(Base, RemoteTask):
         diff_mode = self.args.get('diff_mode', nuka.cli.args.diff)
         klass = self.__class__
 
+        merge_key = not diff_mode and self.merge_key()
+        if merge_key:
+            task = await self.host.merge_tasks(merge_key, self)
+            if task is not self:
+                # task run for us
+                await asyncio.shield(task, loop=self.loop)
+                self.res.update(self.unmerge(task.merged_res))
+                if self.res['rc'] != 0 and not self.ignore_errors:
+                    self.cancel()
+                return
+
         args = {}
         for k, v in self.args.items():
             if k not in ('ctx',):
@@ -281,36 +316,55 @@ class Task(Base, RemoteTask):
             diff_mode=diff_mode,
             log_level=config['log']['levels']['remote_level'])
 
-        if config['testing'] and 'coverage' in self.host.vars:
-            # check if we can/want use coverage
-            cmd = (
-                '{coverage} run -p '
-                '--source={remote_dir}/nuka/tasks '
-                '{script} '
-            ).format(coverage=self.host.vars['coverage'], **config)
+        cmd = script_command(self.host)
+        content_type = stdin_data['content_type'] = wire_content_type(
+            self.host)
+
+        facts = paths = None
+        if use_facts(self.host) and not diff_mode and not self.merged:
+            facts = self.host.facts
+            paths = self.state_paths()
+        if paths:
+            key = facts.key(self, args)
+            res = await facts.get(key)
+            if res is not None:
+                # the task did not change anything last time and the host
+                # did not change since then
+                self.res.update(res)
+                self.meta['cached'] = True
+                return
+            stdin_data['fingerprints'] = paths
+        if facts is not None and not self.read_only:
+            facts.dirty()
+
+        if use_agent(self.host) or use_batch(self.host):
+            if use_agent(self.host):
+                # run the task in the host's persistent remote script
+                get_agent = self.host.get_agent
+            else:
+                # share a remote script with tasks queued at the same time
+                get_agent = self.host.get_batch
+            agent = await get_agent(
+                cmd, task=self,
+                switch_user=self.switch_user,
+                switch_ssh_user=self.switch_ssh_user)
+            proc = agent.create_request(self)
+            stdin = await proc.send_message(stdin_data,
+                                            content_type=content_type)
         else:
-            # use python
-            inventory = self.host.vars.get(
-                'inventory',
-                {'python': {'executable': 'python'}})
-            executable = inventory['python'].get('executable', 'python')
-            cmd = '{0} {script} '.format(executable, **config)
-
-        # allow to trac some ids from ps
-        cmd += '--deploy-id={0} --task-id={1}'.format(config['id'],
-                                                      id(self))
-        # create process
-        proc = await self.host.create_process(
-            cmd, task=self,
-            switch_user=self.switch_user,
-            switch_ssh_user=self.switch_ssh_user)
-
-        # send stdin
-        zlib_avalaible = self.host.inventory['python']['zlib_available']
-        stdin = utils.proto_dumps_std(
-            stdin_data, proc.stdin,
-            content_type=zlib_avalaible and 'zlib' or 'plain')
-        await proc.stdin.drain()
+            # allow to trac some ids from ps
+            cmd += '--deploy-id={0} --task-id={1}'.format(config['id'],
+                                                          id(self))
+            # create process
+            proc = await self.host.create_process(
+                cmd, task=self,
+                switch_user=self.switch_user,
+                switch_ssh_user=self.switch_ssh_user)
+
+            # send stdin
+            stdin = utils.proto_dumps_std(
+                stdin_data, proc.stdin, content_type=content_type)
+            await proc.stdin.drain()
 
         res = {}
         while res.get('message_type') != 'exit':
@@ -326,13 +380,59 @@ class Task(Base, RemoteTask):
             else:
                 if res.get('message_type') == 'log':
                     self.host.log.log(res['level'], res['msg'])
+                elif res.get('message_type') == 'query':
+                    reply = dict(self.reply(res), message_type='reply')
+                    # local files to stream after the reply
+                    streams = reply.pop('streams', [])
+                    reply['streams'] = len(streams)
+                    await proc.send_message(reply, content_type=content_type)
+                    for filename in streams:
+                        await proc.send_file(filename)
 
         # finalize
+        fingerprints = paths and res.pop('fingerprints', None)
         self.res.update(res)
+        if self.merged:
+            # keep the whole result for merged tasks and only keep ours
+            self.merged_res = dict(self.res)
+            self.res.update(self.unmerge(self.merged_res))
+        if facts is not None and not self.read_only:
+            facts.dirty()
+        if paths:
+            if fingerprints is not None and not self.res['changed']:
+                facts.set(key, self.res, fingerprints)
+            else:
+                facts.discard(key)
         if self.res['rc'] != 0 and not self.ignore_errors:
             if not diff_mode:
                 self.cancel()
 
+    def merge_key(self):
+        """return a key. Tasks with the same key queued at the same time on
+        a host are merged in one remote task. None to disable"""
+        return None
+
+    def merge(self, tasks):
+        """update args to also run tasks"""
+        raise NotImplementedError()
+
+    def unmerge(self, res):
+        """return the result of this task from the result of the merged
+        task"""
+        return res
+
+    def state_paths(self):
+        """return the remote paths whose state is enough to know that the
+        task will not change anything. Used by ``--facts`` to skip unchanged
+        tasks. None if the task can not be skipped"""
+        return None
+
+    def reply(self, query):
+        """run locally when the remote task use
+        :meth:`~nuka.remote.task.Task.query`. Must return a dict. Local files
+        listed in ``streams`` are streamed after the reply"""
+        raise NotImplementedError()
+
     def log(self):
         log = self.host.log
         if 'exc' in self.res:
@@ -428,8 +528,22 @@ class setup(SetupTask):
     setup_cmd = (
         '{0}rm -Rf {2[remote_tmp]}; '
         '{0}mkdir -p {2[remote_tmp]} && {0}chmod 777 {2[remote_tmp]} &&'
-        '{0}mkdir -p {2[remote_dir]} &&'
-        'dd bs={1} count=1 | {0}tar -xz -C {2[remote_dir]} && '
+        '{0}mkdir -p {2[remote_dir]} && '
+        # the cache must be private. ignore a directory created by someone
+        # else (eg. another ssh user) and upload the archive without caching
+        'if {0}install -d -m 700 {2[remote_cache]} 2> /dev/null && '
+        '{0}test ! -L {2[remote_cache]} -a -O {2[remote_cache]}; then '
+        # only read the archive from stdin if the host does not have a valid
+        # copy yet
+        'if echo "{4}  {3}" | {0}sha1sum -c --status 2> /dev/null; '
+        'then echo cached; else echo upload && '
+        'tmp=`{0}mktemp {2[remote_cache]}/upload.XXXXXX` && '
+        '{{ dd bs={1} count=1 | {0}tee $tmp > /dev/null; }} && '
+        '{{ echo "{4}  $tmp" | {0}sha1sum -c --status && {0}mv $tmp {3} || '
+        '{{ {0}rm -f $tmp; exit 1; }}; }}; fi && '
+        '{0}tar -xzf {3} -C {2[remote_dir]}; '
+        'else echo upload && '
+        'dd bs={1} count=1 | {0}tar -xz -C {2[remote_dir]}; fi && '
         '{0}`which python 2> /dev/null || which python3 || echo python` '
         '{2[script]} --setup'
     )
@@ -456,24 +570,30 @@ class setup(SetupTask):
         if host.use_sudo:
             sudo = '{sudo} '.format(**config)
 
-        cmd = self.setup_cmd.format(sudo, '{bytes}', config)
+        stdin = remote.build_archive(
+            extra_classes=all_task_classes(),
+            mode='x:gz')
+        archive = '{0}/{1}.tar.gz'.format(
+            config['remote_cache'], remote.build_archive.digests['x:gz'])
+
+        cmd = self.setup_cmd.format(sudo, len(stdin), config, archive,
+                                    remote.build_archive.digests['x:gz'])
 
         mods = nuka.config['inventory_modules'][:]
         mods += self.host.vars.get('inventory_modules', [])
         if mods:
             cmd += ' ' + ' '.join(['--inventory=' + m for m in mods])
-
-        stdin = remote.build_archive(
-            extra_classes=all_task_classes(),
-            mode='x:gz')
-        c = cmd.format(bytes=len(stdin))
-        host.log.debug('Uploading archive ({0}kb)...'.format(
-                int(len(stdin) / 1000)))
+        if config['inventory_cache']:
+            cmd += ' --inventory-cache={remote_cache}/inventory.json'.format(
+                **config)
 
         try:
-            proc = await self.host.create_process(c, task=self)
-            proc.stdin.write(stdin)
-            await proc.stdin.drain()
+            proc = await self.host.create_process(cmd, task=self)
+            if (await proc.stdout.readline()).strip() == b'upload':
+                host.log.debug('Uploading archive ({0}kb)...'.format(
+                        int(len(stdin) / 1000)))
+                proc.stdin.write(stdin)
+                await proc.stdin.drain()
         except (LookupError, OSError, asyncssh.misc.Error) as e:
             if isinstance(e, asyncssh.misc.Error):
                 e = LookupError(str(e), self.host)
@@ -514,6 +634,14 @@ class setup(SetupTask):
         host.log.debug(
             'Inventory:\n{0}'.format(host.vars['inventory']))
 
+        if use_agent(host) and self.res['rc'] == 0:
+            # start the default agent while other tasks are waiting for us
+            try:
+                await host.get_agent(script_command(host), task=self)
+            except (LookupError, OSError, asyncssh.misc.Error) as e:
+                self.host.log.error(e)
+                self.cancel()
+
         if not host.fully_booted.done():
             host.fully_booted.set_result(True)
 
@@ -531,6 +659,9 @@ class teardown(SetupTask):
         return 'teardown'
 
     async def run(self):
+        await self.host.close_agents()
+        if self.host._facts is not None:
+            self.host._facts.save()
         if not self.host.failed():
             sudo = self.host.use_sudo and 'sudo ' or ''
             cmd = self.teardown_cmd.format(sudo, config)
@@ -595,12 +726,26 @@ class wait(Base):
             self.host.add_time(type='task', task=self, **self.meta)
 
 
-async def wait_for_boot(host):
+async def decrypt_files(host, filenames):
+    try:
+        await gpg.decrypt_files(filenames, loop=host.loop)
+    except Exception as e:
+        # Task.render_file() will raise it
+        host.log.debug5('gpg: {0!r}'.format(e))
+
+
+async def wait_for_boot(host, filenames=()):
+    """wait for the host to be ready. gpg files are decrypted meanwhile"""
+    waiters = []
+    if filenames:
+        waiters.append(decrypt_files(host, filenames))
     if not host.fully_booted.done():
         create_setup_tasks(host)
         task = host._named_tasks[setup.__name__]
         if not task.done():
-            await task
+            waiters.append(task)
+    if waiters:
+        await asyncio.gather(*waiters, loop=host.loop)
 
 
 def create_setup_tasks(host):
@@ -613,12 +758,65 @@ def create_setup_tasks(host):
                 host._tasks.append(instance)
 
 
+def use_agent(host):
+    """return True if tasks must run in a persistent remote script"""
+    return host.vars.get('use_agent', config['agent']['enabled'])
+
+
+def use_facts(host):
+    """return True if unchanged tasks can be skipped"""
+    return host.vars.get('use_facts', config['facts']['enabled'])
+
+
+def use_batch(host):
+    """return True if tasks queued at the same time must share a remote
+    script"""
+    return host.vars.get('use_batch', config['agent']['batch'])
+
+
+def script_command(host):
+    """return the command line used to run the remote script"""
+    if config['testing'] and 'coverage' in host.vars:
+        # check if we can/want use coverage
+        cmd = (
+            '{coverage} run -p '
+            '--source={remote_dir}/nuka/tasks '
+            '{script} '
+        ).format(coverage=host.vars['coverage'], **config)
+    else:
+        # use python
+        inventory = host.vars.get(
+            'inventory',
+            {'python': {'executable': 'python'}})
+        executable = inventory['python'].get('executable', 'python')
+        cmd = '{0} {script} '.format(executable, **config)
+    return cmd
+
+
+def wire_content_type(host):
+    """return the content type of messages exchanged with the host's remote
+    script. msgpack is used if both sides have it"""
+    inventory = host.inventory['python']
+    codec = config['protocol']['codec']
+    if codec == 'auto':
+        codec = 'msgpack'
+    if codec == 'msgpack':
+        if utils.msgpack is None or not inventory.get('msgpack_available'):
+            codec = 'plain'
+    else:
+        codec = 'plain'
+    if inventory['zlib_available']:
+        return codec == 'plain' and 'zlib' or codec + '+zlib'
+    return codec
+
+
 def get_task_from_stack():
-    for info in inspect.stack(3):
-        f = info.frame
+    f = sys._getframe()
+    while f is not None:
         self = f.f_locals.get('self')
-        if isinstance(f.f_locals.get('self'), Base):
+        if isinstance(self, Base):
             return self
+        f = f.f_back
 
 
 def all_task_classes(cls=Task):
@@ -8,11 +8,49 @@ import codecs
 
 from nuka.tasks import http
 from nuka.task import Task
-
-import logging as log
+from nuka import utils
 
 GPG_HEADER = b'-----BEGIN PGP PUBLIC KEY BLOCK-----'
 
+DPKG_STATUS = '/var/lib/dpkg/status'
+
+# {filename: (key, packages)}
+_dpkg_status = {}
+
+
+def dpkg_status(filename=DPKG_STATUS):
+    """return ``{package: version}`` for installed packages. The index is
+    kept in memory until dpkg's status file change so tasks running in the
+    same process (``--agent``) share it. It is never stored on disk where
+    other users could alter it"""
+    st = os.stat(filename)
+    key = (int(st.st_mtime * 1000000), st.st_size, st.st_ino)
+    cached = _dpkg_status.get(filename)
+    if cached is not None and cached[0] == key:
+        return dict(cached[1])
+    packages = {}
+
+    def add(package):
+        if package.get('Status', '').endswith(' installed'):
+            version = package.get('Version')
+            packages[package['Package']] = version
+            if 'Architecture' in package:
+                name = '{0[Package]}:{0[Architecture]}'.format(package)
+                packages[name] = version
+
+    package = {}
+    with codecs.open(filename, 'r', 'utf8') as fd:
+        for line in fd:
+            if line[0] not in ' \t' and ':' in line:
+                k, v = line.split(':', 1)
+                package[k] = v.strip()
+            elif not line.strip():
+                add(package)
+                package = {}
+    add(package)
+    _dpkg_status[filename] = (key, packages)
+    return dict(packages)
+
 
 def apt_watcher(delay, fd):
     """watcher for apt using APT::Status-Fd"""
@@ -156,7 +194,7 @@ class update(Task):
                 res = self.sh(args, **kwargs)
                 res['stdout'] = ''
             else:
-                res = self.sh(args + ['update'], **kwargs)
+                res = self.sh(args + ['update'], output='tail', **kwargs)
             if cache:
                 with codecs.open(timestamp_file, 'w', 'utf8') as fd:
                     fd.write(str(time.time()))
@@ -233,14 +271,9 @@ class upgrade(Task):
             to_upgrade = []
             miss_packages = []
             #  we check for all package it they are endeed installed
+            status = dpkg_status()
             for package in self.args['packages']:
-                is_present = self.sh(['dpkg-query',
-                                      '-f', '\'${Status}\'',
-                                      '-W', package],
-                                     check=False)
-                log.warn(is_present['stdout'])
-                if is_present['rc'] or \
-                   " installed" not in is_present['stdout']:
+                if package not in status:
                     #  we don't want installed package
                     miss_packages.append(package)
                     continue
@@ -290,17 +323,59 @@ class install(Task):
 
     def __init__(self, packages=None, debconf=None,
                  debian_frontend='noninteractive', debian_priority=None,
-                 update_cache=None, install_recommends=False, **kwargs):
+                 update_cache=None, install_recommends=False, merge=False,
+                 **kwargs):
         kwargs.setdefault('name', ', '.join(packages or []))
         kwargs.update(packages=packages, debconf=debconf,
                       debian_priority=debian_priority,
                       debian_frontend=debian_frontend,
                       update_cache=update_cache,
                       install_recommends=install_recommends,
+                      merge=merge,
                       )
         super(install, self).__init__(**kwargs)
 
+    def merge_key(self):
+        """installs queued at the same time with ``merge=True`` and the same
+        options run in one ``apt-get install``. The debconf values are part
+        of the options so conflicting values are never merged"""
+        if self.args['merge'] and self.args['packages']:
+            args = dict((k, v) for k, v in self.args.items()
+                        if k not in ('name', 'packages'))
+            return ('apt.install', self.switch_user, self.switch_ssh_user,
+                    utils.json.dumps(args, sort_keys=True))
+
+    def merge(self, tasks):
+        self._packages = self.args['packages']
+        packages = self._packages[:]
+        for task in tasks:
+            packages.extend([p for p in task.args['packages']
+                             if p not in packages])
+        self.args.update(packages=packages)
+
+    def unmerge(self, res):
+        packages = getattr(self, '_packages', self.args['packages'])
+        changed = res.get('changed')
+        if changed and changed is not True:
+            # a list of installed packages
+            res = dict(res, changed=[p for p in changed if p in packages])
+        return res
+
+    def state_paths(self):
+        if self.args['update_cache'] is None:
+            return ['/var/lib/dpkg/status']
+
     def get_packages_list(self, packages):
+        """return installed packages. Only packages with a source
+        (``name/source``) require to query apt"""
+        status = dpkg_status()
+        installed = [p for p in packages if '/' not in p and p in status]
+        sources = [p for p in packages if '/' in p]
+        if sources:
+            installed.extend(self.get_sources_list(sources))
+        return installed
+
+    def get_sources_list(self, packages):
         splited = dict([(p.split('/', 1)[0], p) for p in packages])
         cmd = ['apt-cache', 'policy'] + [k for k in splited.keys()]
         res = self.sh(cmd, check=False)
@@ -382,7 +457,7 @@ class install(Task):
                 res = self.sh(args, **kwargs)
                 res['stdout'] = ''
             else:
-                res = self.sh(args + packages, **kwargs)
+                res = self.sh(args + packages, output='tail', **kwargs)
         else:
             res = dict(rc=0)
         res['changed'] = to_install
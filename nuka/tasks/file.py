@@ -5,8 +5,10 @@ file related tasks
 from nuka.task import Task
 from nuka import utils
 import logging
+import hashlib
 import codecs
 import base64
+import shutil
 import stat
 import glob
 import re
@@ -61,6 +63,9 @@ class mkdir(Task):
             diff = u''.join(res) + u'\n'
         return dict(rc=0, diff=diff, dst=dst)
 
+    def state_paths(self):
+        return [self.args['dst']]
+
 
 class mkdirs(Task):
     """create directories"""
@@ -190,23 +195,56 @@ class chown(Task):
         return dict(rc=0, dst=dst, own=own)
 
 
+def data_digest(fd):
+    """return the sha1 hexdigest of a rendered file descriptor"""
+    data = fd['data']
+    if fd['dst'].endswith(utils.ARCHIVE_EXTS):
+        if not isinstance(data, bytes):
+            data = data.encode('utf8')
+        data = base64.b64decode(data)
+    elif not isinstance(data, bytes):
+        data = data.encode('utf8')
+    return hashlib.sha1(data).hexdigest()
+
+
 class put(Task):
-    """put files on the remote host"""
+    """put files on the remote host.
+
+    Files bigger than ``delta_min_size`` are first sent as a sha1 digest.
+    Their content is only transfered if the remote file differs. Use
+    ``delta_min_size=None`` to always send the content.
+
+    Big files which do not need to be rendered (no template, no gpg) are
+    streamed as raw bytes instead of being embedded in the task's json.
+    """
+
+    delta_min_size = 16 * 1024
 
     def __init__(self, files=None, **kwargs):
         kwargs.setdefault('name', [f['dst'] for f in files or []])
         super(put, self).__init__(files=files, **kwargs)
 
     def pre_process(self):
-        for fd in self.args['files']:
+        min_size = self.args.get('delta_min_size', self.delta_min_size)
+        self._files_data = {}
+        self._files_stream = {}
+        for i, fd in enumerate(self.args['files']):
             if 'linkto' in fd:
                 fd['data'] = None
             elif 'src' in fd:
                 src = fd['src']
                 if src.startswith('~/'):
-                    fd['src'] = os.path.expanduser(src)
+                    src = fd['src'] = os.path.expanduser(src)
                 if src.endswith(('.j2', '.j2.gpg')):
                     self.render_template(fd)
+                elif min_size is not None and not src.endswith('.gpg') and \
+                        os.path.getsize(src) >= min_size:
+                    # raw file. content is streamed by reply() if needed
+                    fd['sha1'] = utils.file_digest(src)
+                    if 'executable' not in fd:
+                        fd['executable'] = utils.isexecutable(src)
+                    self._files_stream[i] = src
+                    continue
                 else:
                     self.render_file(fd)
             elif 'tpl' in fd:
@@ -216,15 +254,70 @@ class put(Task):
                 self.render_template(fd)
             if 'data' not in fd:
                 raise RuntimeError('cant get content for fd {0}'.format(fd))
+            data = fd['data']
+            if min_size is not None and data and len(data) >= min_size:
+                # only send a digest. data is sent by reply() if needed
+                fd['sha1'] = data_digest(fd)
+                self._files_data[i] = fd.pop('data')
+
+    def state_paths(self):
+        paths = [fd['dst'] for fd in self.args['files']]
+        if [p for p in paths if p.startswith('~')]:
+            # depends on the remote user
+            return None
+        return paths
+
+    def reply(self, query):
+        files = [i for i in query['files'] if i in self._files_data]
+        streamed = [i for i in query['files'] if i in self._files_stream]
+        return dict(files=[self._files_data[i] for i in files],
+                    streamed=streamed,
+                    streams=[self._files_stream[i] for i in streamed])
+
+    def fetch_files(self, files):
+        """retrieve the content of files sent as a digest if the remote
+        file differs"""
+        missing = []
+        for i, fd in enumerate(files):
+            if 'sha1' in fd:
+                dst = fd['dst']
+                if dst.startswith('~/'):
+                    dst = os.path.expanduser(dst)
+                if utils.file_digest(dst) == fd['sha1']:
+                    fd['unchanged'] = True
+                else:
+                    missing.append(i)
+        if missing:
+            reply = self.query(files=missing)
+            streamed = reply['streamed']
+            missing = [i for i in missing if i not in streamed]
+            for i, data in zip(missing, reply['files']):
+                files[i]['data'] = data
+            for i, filename in zip(streamed, reply['streams']):
+                files[i]['stream'] = filename
 
     def do(self):
         files = self.args['files'] or []
         files_changed = []
+        self.fetch_files(files)
         for fd in files:
             dst = fd['dst']
             if dst.startswith('~/'):
                 dst = fd['dst'] = os.path.expanduser(dst)
-            if 'linkto' in fd:
+            if fd.get('unchanged'):
+                # same digest as the local file
+                pass
+            elif 'stream' in fd:
+                # raw content stored in a temporary file. fetch_files()
+                # only retrieve files which differ
+                files_changed.append(dst)
+                try:
+                    with open(fd['stream'], 'rb') as src_:
+                        with open(dst, 'wb') as dst_:
+                            shutil.copyfileobj(src_, dst_)
+                finally:
+                    os.remove(fd['stream'])
+            elif 'linkto' in fd:
                 link = fd['linkto']
                 if os.path.exists(dst):
                     if os.path.islink(dst):
@@ -277,9 +370,12 @@ class put(Task):
         diff = ''
         files = self.args['files'] or []
         files_changed = []
+        self.fetch_files(files)
         for fd in files:
             dst = fd['dst']
-            if 'linkto' in fd:
+            if fd.get('unchanged'):
+                continue
+            elif 'linkto' in fd:
                 if os.path.exists(fd['linkto']):
                     new_text = '{0[dst]} -> {0[linkto]}\n'.format(fd)
                 else:
@@ -294,6 +390,19 @@ class put(Task):
                     old_text = ''
                 else:
                     old_text = new_text
+            elif 'stream' in fd:
+                try:
+                    with codecs.open(fd['stream'], 'rb', 'utf8',
+                                     errors='replace') as fd_:
+                        new_text = fd_.read()
+                finally:
+                    os.remove(fd['stream'])
+                if not os.path.isfile(dst):
+                    old_text = ''
+                else:
+                    with codecs.open(dst, 'rb', 'utf8',
+                                     errors='replace') as fd_:
+                        old_text = fd_.read()
             else:
                 new_text = fd['data']
                 if not os.path.isfile(dst):
@@ -310,6 +419,9 @@ class put(Task):
 class scripts(put):
     """put and execute scripts on the remote host"""
 
+    def state_paths(self):
+        return None
+
     def do(self):
         files = self.args['files'] or []
         for f in files:
@@ -320,6 +432,22 @@ class scripts(put):
         return res
 
 
+class fingerprints(Task):
+    """return the fingerprints of remote paths. Used by
+    :class:`~nuka.facts.Facts`"""
+
+    ignore_errors = True
+    read_only = True
+
+    def __init__(self, paths=None, **kwargs):
+        kwargs.setdefault('name', '{0} paths'.format(len(paths or [])))
+        super(fingerprints, self).__init__(paths=paths, **kwargs)
+
+    def do(self):
+        return dict(rc=0, changed=False,
+                    fingerprints=utils.fingerprints(self.args['paths']))
+
+
 class cat(Task):
     """cat a file"""
 
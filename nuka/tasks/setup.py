@@ -1,6 +1,8 @@
 import os
 import sys
+import time
 import codecs
+import tempfile
 from nuka.task import Task
 from nuka.utils import json
 from nuka.utils import import_module
@@ -13,6 +15,11 @@ class setup(Task):
         modules = [m.split('=')[1] for m in sys.argv
                    if m.startswith('--inventory=')]
         modules.insert(0, 'nuka.inventory.python')
+        caches = [m.split('=', 1)[1] for m in sys.argv
+                  if m.startswith('--inventory-cache=')]
+        entries = None
+        if caches:
+            entries = self.load_cache(caches[0])
 
         inventory = {}
         done = set()
@@ -22,9 +29,74 @@ class setup(Task):
                 mod = import_module(name)
                 meth = getattr(mod, 'update_inventory', None)
                 if meth is not None:
-                    meth(inventory)
+                    self.update_section(name, mod, meth, inventory, entries)
+        if caches:
+            self.save_cache(caches[0], entries)
         return {'inventory': inventory}
 
+    @classmethod
+    def update_section(self, name, mod, meth, inventory, entries):
+        """update the inventory with a module. Modules with an
+        ``inventory_ttl`` are cached until the ttl expires or the value of
+        their ``inventory_key()`` change. The cached section contains the
+        keys added or modified by the module"""
+        ttl = getattr(mod, 'inventory_ttl', None)
+        if ttl is None or entries is None:
+            meth(inventory)
+            return
+        get_key = getattr(mod, 'inventory_key', None)
+        key = get_key() if get_key is not None else None
+        now = time.time()
+        entry = entries.get(name)
+        if entry is not None and entry['key'] == key:
+            if now - entry['time'] < ttl:
+                inventory.update(entry['data'])
+                return
+        before = dict((k, json.dumps(v, sort_keys=True))
+                      for k, v in inventory.items())
+        meth(inventory)
+        section = dict((k, v) for k, v in inventory.items()
+                       if before.get(k) != json.dumps(v, sort_keys=True))
+        entries[name] = dict(time=now, key=key, data=section)
+
+    @classmethod
+    def load_cache(self, filename):
+        """return cached entries. Ignore files we do not own and invalid
+        entries"""
+        try:
+            st = os.lstat(filename)
+            if st.st_uid != os.getuid() or not os.path.isfile(filename) or \
+               os.path.islink(filename):
+                return {}
+            with codecs.open(filename, 'r', 'utf8') as fd:
+                entries = json.load(fd)
+        except (IOError, OSError, ValueError):
+            return {}
+        if not isinstance(entries, dict):
+            return {}
+        valid = {}
+        for name, entry in entries.items():
+            if isinstance(entry, dict) and \
+               isinstance(entry.get('time'), (int, float)) and \
+               isinstance(entry.get('data'), dict) and 'key' in entry:
+                valid[name] = entry
+        return valid
+
+    @classmethod
+    def save_cache(self, filename, entries):
+        try:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename),
+                                       prefix='.inventory')
+        except (IOError, OSError):
+            # the cache is not required
+            return
+        try:
+            with os.fdopen(fd, 'w') as fd:
+                fd.write(json.dumps(entries))
+            os.rename(tmp, filename)
+        except (IOError, OSError):
+            os.unlink(tmp)
+
     def do(self):
         dirname = os.path.dirname(sys.argv[0])
         cache = os.path.join(dirname, 'inventory.json')
@@ -15,7 +15,7 @@ class commands(Task):
 
     def do(self):
         for cmd in self.args['cmds']:
-            kwargs = {}
+            kwargs = {'output': self.args.get('output')}
             watch = self.args.get('watch')
             if watch:  # pragma: no cover
                 kwargs['watcher'] = utils.default_watcher(delay=watch)
@@ -32,7 +32,7 @@ class command(Task):
         super(command, self).__init__(cmd=cmd, **kwargs)
 
     def do(self):
-        kwargs = {}
+        kwargs = {'output': self.args.get('output')}
         watch = self.args.get('watch')
         if watch:  # pragma: no cover
             kwargs['watcher'] = utils.default_watcher(delay=watch)
@@ -49,7 +49,7 @@ class shell(Task):
         super(shell, self).__init__(cmd=cmd, **kwargs)
 
     def do(self):
-        kwargs = {'shell': True}
+        kwargs = {'shell': True, 'output': self.args.get('output')}
         watch = self.args.get('watch')
         if watch:  # pragma: no cover
             kwargs['watcher'] = utils.default_watcher(delay=watch)
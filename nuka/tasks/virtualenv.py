@@ -84,7 +84,7 @@ class virtualenv(file.put):
                 if self.args.get('upgrade'):
                     cmd.append('--upgrade')
                 cmd.extend(['-r', f['dst']])
-                self.sh(cmd)
+                self.sh(cmd, output='tail')
         res.update(python=binary)
         return res
 
@@ -47,6 +47,11 @@ try:
 except ImportError:
     zlib = None
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 try:
     import ujson as json
 except ImportError:
@@ -69,6 +74,9 @@ except ImportError:
 
 ARCHIVE_EXTS = ('.gz', '.tar', '.zip')
 
+# smaller messages are not worth compressing
+ZLIB_MIN_SIZE = 512
+
 LOG = 60
 logging.addLevelName(LOG, 'LOG')
 CHANGED = logging.WARNING + 1
@@ -173,6 +181,36 @@ def isexecutable(path):
     return os.access(path, os.X_OK)
 
 
+def file_digest(filename):
+    """return the sha1 hexdigest of a file. None if the file does not
+    exist"""
+    import hashlib
+    h = hashlib.sha1()
+    try:
+        with open(filename, 'rb') as fd:
+            chunk = fd.read(65536)
+            while chunk:
+                h.update(chunk)
+                chunk = fd.read(65536)
+    except (OSError, IOError):
+        return None
+    return h.hexdigest()
+
+
+def fingerprints(paths):
+    """return ``{path: [ctime, size]}``. Value is None if path does not
+    exist"""
+    res = {}
+    for path in paths:
+        try:
+            st = os.lstat(path)
+        except OSError:
+            res[path] = None
+        else:
+            res[path] = [int(st.st_ctime * 1000000), st.st_size]
+    return res
+
+
 class secret(object):
     """secret word generation::
 
@@ -232,22 +270,90 @@ class secret(object):
         return next(self.iterator)
 
 
+def proto_codec(content_type):
+    """return the ``(codec, compressed)`` of a content type::
+
+        >>> proto_codec('zlib')
+        ('plain', True)
+        >>> proto_codec('msgpack+zlib')
+        ('msgpack', True)
+        >>> proto_codec('msgpack')
+        ('msgpack', False)
+    """
+    codec, _, compression = content_type.partition('+')
+    if codec == 'zlib':
+        # json + zlib
+        return 'plain', True
+    return codec, compression == 'zlib'
+
+
 def proto_dumps(data, content_type=u'plain'):
-    """json.dumps() with headers. py2/3 compat"""
-    data = json.dumps(data)
-    if not isinstance(data, bytes):
-        data = data.encode('utf8')
-    if content_type == u'zlib':
-        if zlib is not None:
-            data = zlib.compress(data)
-        else:
-            content_type = u'plain'
+    """serialize data with headers. ``content_type`` is ``plain`` (json) or
+    ``msgpack``, optionally compressed (``zlib``, ``msgpack+zlib``). Messages
+    smaller than ``ZLIB_MIN_SIZE`` are never compressed. py2/3 compat"""
+    codec, compressed = proto_codec(content_type)
+    if codec == u'msgpack' and msgpack is not None:
+        data = msgpack.packb(data, use_bin_type=False)
+    else:
+        codec = u'plain'
+        data = json.dumps(data)
+        if not isinstance(data, bytes):
+            data = data.encode('utf8')
+    content_type = codec
+    if compressed and zlib is not None and len(data) >= ZLIB_MIN_SIZE:
+        data = zlib.compress(data)
+        content_type = codec == u'plain' and u'zlib' or codec + u'+zlib'
     headers = (
         u'Content-type: {0}\nContent-Length: {1}\n'
     ).format(content_type, len(data)).encode('utf8')
     return headers + data
 
 
+def proto_loads(data, content_type=u'plain'):
+    """deserialize a message body. py2/3 compat"""
+    codec, compressed = proto_codec(content_type)
+    if compressed:
+        data = zlib.decompress(data)
+    if codec == 'msgpack':
+        try:
+            return msgpack.unpackb(data, raw=False, strict_map_key=False)
+        except TypeError:  # pragma: no cover
+            # msgpack < 1.0
+            return msgpack.unpackb(data, encoding='utf8')
+    if isinstance(data, bytes):
+        data = data.decode('utf8')
+    try:
+        data = json.loads(data)
+    except ValueError:
+        raise ValueError(data)
+    return data
+
+
+def proto_dumps_binary(data, request_id=None):
+    """raw bytes with headers. Used to stream files. py2/3 compat"""
+    content_type = u'binary'
+    if request_id is not None:
+        content_type += u'; request_id={0}'.format(request_id)
+    headers = (
+        u'Content-type: {0}\nContent-Length: {1}\n'
+    ).format(content_type, len(data)).encode('utf8')
+    return headers + data
+
+
+def proto_params(message):
+    """return the parameters of a message's content type::
+
+        >>> proto_params(b'Content-type: binary; request_id=1\\n')
+        {'request_id': '1'}
+    """
+    content_type = message[:message.find(b'\n')].decode('utf8')
+    params = {}
+    for param in content_type.split(';')[1:]:
+        key, value = param.split('=', 1)
+        params[key.strip()] = value.strip()
+    return params
+
+
 def proto_dumps_std(data, std, content_type='plain'):
     """json.dumps() to std with headers. py2/3 compat"""
     data = proto_dumps(data, content_type=content_type)
@@ -255,9 +361,10 @@ def proto_dumps_std(data, std, content_type='plain'):
     std.write(data)
 
 
-def proto_dumps_std_threadsafe(data, std):
+def proto_dumps_std_threadsafe(data, std, content_type=None):
     _write_lock.acquire()
-    content_type = zlib is None and u'plain' or u'zlib'
+    if content_type is None:
+        content_type = zlib is None and u'plain' or u'zlib'
     try:
         proto_dumps_std(data, std, content_type=content_type)
         std.flush()
@@ -265,6 +372,32 @@ def proto_dumps_std_threadsafe(data, std):
         _write_lock.release()
 
 
+def proto_split(data):
+    """split the first message from a buffer. return ``(message, remaining)``
+    where message is ``None`` if the buffer does not contain a full message
+    yet. py2/3 compat::
+
+        >>> proto_split(b'Content-type: plain\\nContent-Length: 2\\n{}{')
+        (b'Content-type: plain\\nContent-Length: 2\\n{}', b'{')
+        >>> proto_split(b'Content-type: plain\\nContent-Length: 2\\n{')
+        (None, b'Content-type: plain\\nContent-Length: 2\\n{')
+    """
+    first = data.find(b'\n')
+    if first < 0:
+        return None, data
+    second = data.find(b'\n', first + 1)
+    if second < 0:
+        return None, data
+    try:
+        content_length = int(data[first + 1:second].split(b':')[1].strip())
+    except (IndexError, ValueError):
+        raise ValueError(data[:second])
+    end = second + 1 + content_length
+    if len(data) < end:
+        return None, data
+    return data[:end], data[end:]
+
+
 def proto_loads_std(std):
     """json.loads() from std with headers. py2/3 compat"""
     if isinstance(std, bytes):
@@ -287,12 +420,12 @@ def proto_loads_std(std):
     except IndexError:
         raise ValueError(content_length)
     data = std.read(content_length)
-    if content_type == 'zlib':
-        data = zlib.decompress(data)
-    if isinstance(data, bytes):
-        data = data.decode('utf8')
-    try:
-        data = json.loads(data)
-    except ValueError:
-        raise ValueError(data)
-    return data
+    while len(data) < content_length:
+        # unbuffered streams may return less than requested
+        chunk = std.read(content_length - len(data))
+        if not chunk:
+            break
+        data += chunk
+    if content_type.startswith('binary'):
+        return data
+    return proto_loads(data, content_type)
@@ -10,7 +10,7 @@ from nuka.hosts import DockerContainer
 from nuka.hosts import Vagrant
 import nuka
 
-nuka.config['log']['dirname'] = '.nuka/logs'
+nuka.config['log']['dirname'] = os.path.join(nuka.config['nuka_dir'], 'logs')
 nuka.config['log']['levels'] = {
     'stream_level': logging.DEBUG,
     'file_level': logging.DEBUG,
@@ -42,11 +42,11 @@ setup(
         'pyaml',
         'jinja2',
         'uvloop',
-        'asyncssh>=1.12.0',
+        'asyncssh>=1.16.0',
     ],
     extras_require={
         'full': ['tox'] + full,
-        'speedup': ['ujson'],
+        'speedup': ['ujson', 'msgpack'],
         'docker': docker,
         'cloud': cloud,
         'test': full,
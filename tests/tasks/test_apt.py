@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
+from nuka.hosts import base
 from nuka.tasks import apt
+import asyncio
 import pytest
 import os
 
@@ -59,3 +61,93 @@ async def test_install_diff(host, diff_mode):
         res = await apt.install(packages=['moreutils'])
         assert res.rc == 0
         assert '+moreutils\n' in res.res['diff'], res.res['diff']
+
+
+def test_dpkg_status(tmpdir):
+    filename = tmpdir.join('status')
+    filename.write('\n'.join([
+        'Package: bash',
+        'Status: install ok installed',
+        'Architecture: amd64',
+        'Version: 4.4',
+        'Description: shell',
+        ' Version: 0',
+        '',
+        'Package: vim',
+        'Status: deinstall ok config-files',
+        'Version: 8.0',
+        '',
+    ]))
+    expected = {'bash': '4.4', 'bash:amd64': '4.4'}
+    assert apt.dpkg_status(str(filename)) == expected
+    # cached in memory only
+    assert str(filename) in apt._dpkg_status
+    assert not tmpdir.join('dpkg_status.json').check()
+    assert apt.dpkg_status(str(filename)) == expected
+
+    # invalidated when dpkg's status change
+    filename.write('Package: zsh\nStatus: install ok installed\n'
+                   'Version: 5.4\n')
+    assert apt.dpkg_status(str(filename)) == {'zsh': '5.4'}
+
+
+def test_install_merge():
+    tasks = []
+    for packages in (['a'], ['b', 'a']):
+        task = apt.install.__new__(apt.install)
+        task.args = dict(packages=packages, debconf=None, merge=True)
+        tasks.append(task)
+    tasks[0].merge(tasks[1:])
+    assert tasks[0].args['packages'] == ['a', 'b']
+    res = dict(rc=0, changed=['b'])
+    assert tasks[0].unmerge(res)['changed'] == []
+    assert tasks[1].unmerge(res)['changed'] == ['b']
+
+
+def test_install_merge_run():
+    loop = asyncio.new_event_loop()
+    host = base.BaseHost(address='merge', loop=loop, use_facts=False,
+                         use_agent=False, use_batch=False,
+                         inventory={'python': {'zlib_available': False}})
+    host.fully_booted.set_result(True)
+    calls = []
+
+    class Stdin:
+
+        def write(self, data):
+            pass
+
+        async def drain(self):
+            pass
+
+    class Proc:
+        stdin = Stdin()
+
+        async def next_message(self):
+            # everything was installed
+            return dict(message_type='exit', rc=0,
+                        changed=calls[-1]['packages'])
+
+    async def create_process(cmd, task=None, **kwargs):
+        calls.append(dict(task.args))
+        return Proc()
+    host.create_process = create_process
+
+    def run(*tasks):
+        calls[:] = []
+        return loop.run_until_complete(asyncio.gather(*tasks, loop=loop))
+
+    # queued in the same loop iteration. one remote call
+    res = run(apt.install(['a', 'b'], merge=True, host=host),
+              apt.install(['c', 'a'], merge=True, host=host))
+    assert [c['packages'] for c in calls] == [['a', 'b', 'c']]
+    assert [r.res['changed'] for r in res] == [['a', 'b'], ['a', 'c']]
+
+    # conflicting debconf values are not merged
+    res = run(apt.install(['a'], merge=True, host=host,
+                          debconf={'a': 'one'}),
+              apt.install(['b'], merge=True, host=host,
+                          debconf={'a': 'two'}))
+    assert sorted(c['debconf']['a'] for c in calls) == ['one', 'two']
+    assert [r.res['changed'] for r in res] == [['a'], ['b']]
+    loop.close()
@@ -84,6 +84,20 @@ async def test_put(host):
     assert res.content == 'yo'
 
 
+@pytest.mark.asyncio
+async def test_put_delta(host):
+    with open('/tmp/to_put.txt', 'wb') as fd:
+        fd.write(b'yo')
+    res = await file.put([dict(src='/tmp/to_put.txt', dst='/tmp/xx_delta')],
+                         delta_min_size=0)
+    assert res.res['changed'] == ['/tmp/xx_delta']
+    res = await file.put([dict(src='/tmp/to_put.txt', dst='/tmp/xx_delta')],
+                         delta_min_size=0)
+    assert res.res['changed'] == []
+    res = await file.cat('/tmp/xx_delta')
+    assert res.content == 'yo'
+
+
 @pytest.mark.asyncio
 async def test_put_with_user(host, user):
     with open('/tmp/to_put.txt', 'wb') as fd:
@@ -1,15 +1,16 @@
 # -*- coding: utf-8 -*-
 from nuka.tasks import file
+from nuka import gpg
+import asyncio
 import pytest
 import os
 
-pytestmark = [
-    pytest.mark.skipif(
-        'gawel' not in os.getenv('GPG_AGENT_INFO', ''),
-        reason='gawel not found in GPG_AGENT_INFO')
-]
+gpg_agent = pytest.mark.skipif(
+    'gawel' not in os.getenv('GPG_AGENT_INFO', ''),
+    reason='gawel not found in GPG_AGENT_INFO')
 
 
+@gpg_agent
 @pytest.mark.asyncio
 async def test_gpg_file(host):
     res = await file.put([dict(src='tests/templates/gpg.txt.gpg',
@@ -19,6 +20,7 @@ async def test_gpg_file(host):
     assert res.content == 'yo {{name}}\n'
 
 
+@gpg_agent
 @pytest.mark.asyncio
 async def test_gpg_template(host):
     res = await file.put([dict(src='gpg.j2.gpg', dst='/tmp/gpg.j2')],
@@ -26,3 +28,50 @@ async def test_gpg_template(host):
     assert bool(res)
     res = await file.cat('/tmp/gpg.j2')
     assert res.content == 'yo dude\n'
+
+
+@pytest.fixture
+def gpg_calls(monkeypatch):
+    calls = []
+
+    def check_output(cmd):
+        calls.append(cmd[-1])
+        with open(cmd[-1], 'rb') as fd:
+            return fd.read().upper()
+    monkeypatch.setattr(gpg.subprocess, 'check_output', check_output)
+    monkeypatch.setattr(gpg, '_cache', {})
+    return calls
+
+
+def test_gpg_cache(tmpdir, gpg_calls):
+    filename = str(tmpdir.join('secret.txt.gpg'))
+    with open(filename, 'w') as fd:
+        fd.write('secret')
+    assert not gpg.is_cached(filename)
+    assert gpg.decrypt(filename) == (filename[:-4], 'SECRET')
+    assert gpg.is_cached(filename)
+    # hit
+    assert gpg.decrypt(filename) == (filename[:-4], 'SECRET')
+    assert gpg_calls == [filename]
+
+    # a new mtime invalidates the cache
+    with open(filename, 'w') as fd:
+        fd.write('changed')
+    os.utime(filename, (1, 1))
+    assert not gpg.is_cached(filename)
+    assert gpg.decrypt(filename) == (filename[:-4], 'CHANGED')
+    assert gpg_calls == [filename] * 2
+
+
+def test_gpg_decrypt_files(tmpdir, gpg_calls):
+    filenames = []
+    for name in ('a.gpg', 'b.gpg'):
+        filename = str(tmpdir.join(name))
+        with open(filename, 'w') as fd:
+            fd.write(name)
+        filenames.append(filename)
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(gpg.decrypt_files(filenames * 2, loop=loop))
+    loop.close()
+    assert sorted(gpg_calls) == filenames
+    assert all(gpg.is_cached(f) for f in filenames)
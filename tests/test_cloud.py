@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+import threading
+import asyncio
+import pytest
+
+import nuka
+
+pytest.importorskip('libcloud')
+pytest.importorskip('novaclient')
+
+from nuka.hosts import cloud  # NOQA
+
+
+class Server:
+
+    def __init__(self, name, status='BUILD'):
+        self.name = name
+        self.status = status
+
+
+class Servers:
+    """a nova driver. Servers are running after ``boot_after`` lists"""
+
+    def __init__(self, boot_after=2):
+        self.boot_after = boot_after
+        self.servers = {}
+        self.calls = []
+
+    def find(self, name):
+        self.calls.append('find')
+        raise cloud.NotFound(404)
+
+    def create(self, name, **kwargs):
+        self.calls.append('create')
+        server = self.servers[name] = Server(name)
+        return server
+
+    def list(self):
+        self.calls.append('list')
+        if self.calls.count('list') >= self.boot_after:
+            for server in self.servers.values():
+                server.status = 'ACTIVE'
+        return [Server(s.name, s.status) for s in self.servers.values()]
+
+
+class Driver:
+
+    def __init__(self, **kwargs):
+        self.servers = Servers(**kwargs)
+
+
+@pytest.fixture
+def driver(monkeypatch):
+    def _driver(**kwargs):
+        driver = Driver(**kwargs)
+        monkeypatch.setattr(cloud, 'driver_from_config',
+                            lambda *args, **kwargs: driver)
+        return driver
+    monkeypatch.setattr(cloud, 'get_task_from_stack', lambda: 'boot')
+    monkeypatch.setitem(nuka.config, 'cloud', dict(
+        poll_delay=.01, max_poll_delay=.02, timeout=2))
+    return _driver
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+
+    async def sshd(reader, writer):
+        writer.write(b'SSH-2.0-test\r\n')
+        writer.close()
+
+    server = loop.run_until_complete(
+        asyncio.start_server(sshd, '127.0.0.1', 0, loop=loop))
+    loop.port = str(server.sockets[0].getsockname()[1])
+    yield loop
+    server.close()
+    loop.close()
+
+
+def get_hosts(loop, *names):
+    hosts = [cloud.OpenstackHost(name, public_ip='127.0.0.1', loop=loop)
+             for name in names]
+    for h in hosts:
+        # probe our fake sshd
+        h.vars['port'] = loop.port
+    return hosts
+
+
+def test_create_and_poll(driver, loop):
+    d = driver(boot_after=3)
+    hosts = get_hosts(loop, 'poll1', 'poll2')
+    loop.run_until_complete(asyncio.gather(
+        *[h.boot() for h in hosts], loop=loop))
+    assert sorted(d.servers.calls) == ['create'] * 2 + ['find'] * 2 + \
+        ['list'] * 3
+    for h in hosts:
+        assert h._node.status == 'ACTIVE'
+        assert not h.cancelled()
+        names = [t['name'] for t in h._task_times]
+        # each host records the shared list calls
+        assert names.count('driver.list_nodes()') == 3
+        assert 'ssh probe' in names
+
+
+def test_poll_timeout(driver, loop):
+    nuka.config['cloud']['timeout'] = .1
+    d = driver(boot_after=1000)
+    host, = get_hosts(loop, 'timeout1')
+    host._node = d.servers.create('timeout1')
+    with pytest.raises(asyncio.TimeoutError):
+        loop.run_until_complete(host.wait_for_node(task='boot'))
+    poller = cloud.get_poller(host.provider, host.driver_args, loop)
+    assert poller.pending == {}
+
+
+def test_group_boot(driver, loop, monkeypatch):
+    d = driver(boot_after=2)
+    servers = d.servers.servers
+    servers['running'] = Server('running', 'ACTIVE')
+    servers['building'] = Server('building')
+    # creations must run at the same time
+    barrier = threading.Barrier(2, timeout=1)
+    create = d.servers.create
+
+    def create_in_parallel(name, **kwargs):
+        barrier.wait()
+        return create(name, **kwargs)
+    monkeypatch.setattr(d.servers, 'create', create_in_parallel)
+
+    group = cloud.Cloud(cloud.Provider.OPENSTACK)
+    lists = []
+
+    def list_nodes():
+        lists.append(1)
+        return cloud.Cloud.list_nodes(group)
+    monkeypatch.setattr(group, 'list_nodes', list_nodes)
+
+    names = ['running', 'building', 'missing1', 'missing2']
+    hosts = [group.get_or_create_node(name, public_ip='127.0.0.1', loop=loop)
+             for name in names]
+    for h in hosts:
+        h.vars['port'] = loop.port
+    loop.run_until_complete(asyncio.gather(
+        *[h.boot() for h in hosts], loop=loop))
+    assert len(lists) == 1
+    assert 'find' not in d.servers.calls
+    assert d.servers.calls.count('create') == 2
+    for h in hosts:
+        assert h._node.status == 'ACTIVE'
+    # only nodes that were not running waited for them
+    assert [h.name for h in hosts if h._created] == names[1:]
+    for h in hosts[1:]:
+        assert 'ssh probe' in [t['name'] for t in h._task_times]
+    # the group list is recorded in the boot task
+    assert 'driver.list_nodes()' in [
+        t['name'] for t in hosts[0]._task_times]
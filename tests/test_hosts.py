@@ -1,7 +1,12 @@
 # -*- coding: utf-8 -*-
 import asyncio
+import struct
 import pytest
+import asyncssh
+from nuka.hosts import docker_api
 from nuka.hosts import base
+from nuka import process
+import nuka
 
 
 def test_basehost():
@@ -46,6 +51,231 @@ async def test_host_session(host):
     assert len(host._sessions) == 0
 
 
+def test_slots():
+    loop = asyncio.new_event_loop()
+    slots = base.Slots(1)
+    order = []
+
+    async def acquire(name, priority=0):
+        await slots.acquire(loop, priority)
+        order.append(name)
+        await asyncio.sleep(0, loop=loop)
+        slots.release()
+
+    loop.run_until_complete(asyncio.gather(
+        acquire('first'), acquire('low'), acquire('high', priority=1),
+        loop=loop))
+    loop.close()
+    assert order == ['first', 'high', 'low']
+    assert len(slots) == 0
+
+
+def test_connections_rate():
+    loop = asyncio.new_event_loop()
+    rate = process.ConnectionsRate(100, max_rate=400)
+    start = loop.time()
+    loop.run_until_complete(asyncio.gather(
+        *[rate.acquire(loop) for i in range(11)], loop=loop))
+    # one token is available then 100 per second
+    assert .09 < loop.time() - start < .5
+    loop.close()
+
+    rate.increase()
+    assert rate.rate == 200
+    rate.increase()
+    rate.increase()
+    assert rate.rate == 400
+    for i in range(10):
+        rate.decrease()
+    assert rate.rate == 10
+
+
+def test_run_in_executor():
+    host = base.BaseHost(address='127.0.0.1')
+    host.loop = asyncio.new_event_loop()
+    res = host.loop.run_until_complete(
+        host.run_in_executor(lambda: 1, kind='create', task='task'))
+    host.loop.close()
+    assert res == 1
+    assert host._task_times[-1]['name'] == 'queue(create)'
+    assert base.get_executor(None, 'create') in base.executors.values()
+
+
+def test_batch_agents():
+    loop = asyncio.new_event_loop()
+    host = base.BaseHost(address='127.0.0.1', loop=loop)
+    started = []
+
+    class Agent:
+        closed = False
+
+        def __init__(self):
+            self.reader = asyncio.Future(loop=loop)
+
+        def close(self):
+            self.closed = True
+
+        async def wait_closed(self):
+            self.close()
+
+    async def start_agent(cmd, task=None, **kwargs):
+        started.append(Agent())
+        return started[-1]
+    host._start_agent = start_agent
+
+    agents = loop.run_until_complete(asyncio.gather(
+        host.get_batch('cmd'), host.get_batch('cmd'), loop=loop))
+    assert agents[0] is agents[1] is started[0]
+    assert agents[0].pending == 2
+    assert len(host._batch_agents) == 1
+    # the agent is forgotten once done
+    started[0].reader.set_result(None)
+    loop.run_until_complete(asyncio.sleep(0, loop=loop))
+    assert host._batch_agents == set()
+
+    # running batches are closed at teardown
+    loop.run_until_complete(host.get_batch('cmd'))
+    loop.run_until_complete(host.close_agents())
+    assert started[1].closed
+    assert host._batch_agents == set()
+    loop.close()
+
+
+def test_session_refused(monkeypatch):
+    loop = asyncio.new_event_loop()
+    host = base.Host(hostname='refused', loop=loop)
+    calls = []
+
+    class Proc:
+
+        async def redirect(self, *args):
+            pass
+
+        async def exit(self):
+            pass
+
+    class Conn:
+
+        async def create_session(self, factory, cmd, **kwargs):
+            calls.append(cmd)
+            if len(calls) < 3:
+                # sshd's MaxSessions
+                raise asyncssh.ChannelOpenError(
+                    asyncssh.OPEN_ADMINISTRATIVELY_PROHIBITED, 'refused')
+            return None, Proc()
+
+    uid = (host.vars['user'], host)
+    monkeypatch.setitem(process.asyncssh_connections, uid,
+                        dict(conn=Conn()))
+    monkeypatch.setattr(process, 'MAX_CHANNEL_DELAY', .2)
+    proc = loop.run_until_complete(
+        process.create(host.wraps_command_line('ls'), host))
+    assert isinstance(proc, Proc)
+    assert len(calls) == 3
+    # the connection is kept
+    assert 'conn' in process.asyncssh_connections[uid]
+    assert len(host._sessions) == 1
+    host.free_session_slot()
+
+    # give up after MAX_CHANNEL_DELAY
+    calls[:] = []
+    monkeypatch.setattr(process, 'MAX_CHANNEL_DELAY', .1)
+    with pytest.raises(asyncssh.ChannelOpenError):
+        loop.run_until_complete(
+            process.create(host.wraps_command_line('ls'), host))
+    assert len(calls) == 2
+    assert len(host._sessions) == 0
+    loop.close()
+
+
+def test_docker_api(tmpdir):
+    connections = []
+
+    async def daemon(reader, writer):
+        connections.append(writer)
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            method, path = line.decode().split()[:2]
+            headers = {}
+            while True:
+                header = (await reader.readline()).decode().strip()
+                if not header:
+                    break
+                k, v = header.split(':', 1)
+                headers[k.lower()] = v.strip()
+            await reader.readexactly(int(headers['content-length']))
+            if path.endswith('/exec'):
+                writer.write(b'HTTP/1.1 201 Created\r\n'
+                             b'Content-Length: 11\r\n\r\n{"Id": "1"}')
+            elif path.endswith('/start'):
+                writer.write(b'HTTP/1.1 101 UPGRADED\r\n\r\n')
+                writer.write(b'\x02\x00\x00\x00\x00\x00\x00\x03err')
+                data = await reader.read()
+                writer.write(struct.pack('>BxxxL', 1, len(data)) + data)
+                writer.close()
+                break
+            else:
+                writer.write(b'HTTP/1.1 200 OK\r\n'
+                             b'Transfer-Encoding: chunked\r\n\r\n'
+                             b'13\r\n{"Running": false, \r\n'
+                             b'd\r\n"ExitCode": 2\r\n1\r\n}\r\n0\r\n\r\n')
+
+    async def run():
+        server = await asyncio.start_unix_server(
+            daemon, str(tmpdir.join('docker.sock')), loop=host.loop)
+        res = []
+        for i in range(2):
+            proc = await docker_api.create(['cat'], host)
+            proc.stdin.write(b'echo')
+            await proc.stdin.drain()
+            proc.stdin.close()
+            res.append((await proc.stdout.read(), await proc.stderr.read(),
+                        await proc.wait()))
+        docker_api.get_api().close()
+        server.close()
+        await server.wait_closed()
+        await asyncio.sleep(.01, loop=host.loop)
+        return res
+
+    nuka.config['docker']['socket'] = str(tmpdir.join('docker.sock'))
+    host = base.BaseHost(address='127.0.0.1')
+    host.loop = asyncio.new_event_loop()
+    res = host.loop.run_until_complete(run())
+    host.loop.close()
+    docker_api.apis.clear()
+    assert res == [(b'echo', b'err', 2)] * 2
+    # idle connections are reused then hijacked by the exec instances
+    assert len(connections) == 3
+
+
+def test_docker_images():
+    loop = asyncio.new_event_loop()
+    api = docker_api.DockerAPI('docker.sock', loop=loop)
+    requests = []
+
+    async def request(method, path, params=None, body=None):
+        requests.append((path, params))
+        return docker_api.Response(200, {}, b'')
+    api.request = request
+
+    digest = 'registry:5000/img@sha256:' + 'a' * 64
+    for image in ('debian', 'debian:stretch', 'registry:5000/img',
+                  'registry:5000/img:tag', digest):
+        loop.run_until_complete(api.pull(image))
+    loop.run_until_complete(api.has_image('registry:5000/img:tag'))
+    loop.close()
+    assert [r[1] for r in requests[:5]] == [
+        dict(fromImage='debian', tag='latest'),
+        dict(fromImage='debian', tag='stretch'),
+        dict(fromImage='registry:5000/img', tag='latest'),
+        dict(fromImage='registry:5000/img', tag='tag'),
+        dict(fromImage=digest),
+    ]
+    assert requests[-1][0] == '/images/registry%3A5000%2Fimg%3Atag/json'
+
+
 @pytest.mark.asyncio
 async def test_host_cancelled(host):
     host.cancel()
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import asyncio
 import nuka
 
 
@@ -13,3 +14,84 @@ def test_event():
 
     e = nuka.Event('three')
     assert '<Event three' in repr(e)
+
+
+def test_render_template():
+    config = nuka.config
+    ctx = dict(name='dude')
+    assert config.render_template('example.j2', ctx) == 'yo dude\n'
+    renders = len(config['template_renders'])
+    assert config.render_template('example.j2', ctx) == 'yo dude\n'
+    assert len(config['template_renders']) == renders
+    ctx = dict(name='dude', host=object())
+    assert config.render_template('example.j2', ctx) == 'yo dude\n'
+    assert len(config['template_renders']) == renders
+    ctx = dict(name='other')
+    assert config.render_template('example.j2', ctx) == 'yo other\n'
+    assert len(config['template_renders']) == renders + 1
+    # values that json can't tell apart are not cached
+    for name in (['a'], ('a',), {1: 'a'}, {'1': 'a'}):
+        res = config.render_template('example.j2', dict(name=name))
+        assert res == 'yo {0}\n'.format(name)
+    # only the list and the dict with a str key
+    assert len(config['template_renders']) == renders + 3
+
+
+def run_rolling(hosts, fail=(), **kwargs):
+    started = []
+
+    async def job(host):
+        started.append(host.name)
+        if host.name in fail:
+            raise RuntimeError(host.name)
+        return host.name
+
+    return nuka.run_rolling(job, *hosts, **kwargs), started
+
+
+def test_run_rolling(monkeypatch, caplog):
+    from nuka.hosts import base
+    # the default loop may have been closed by previous asyncio tests
+    loop = asyncio.new_event_loop()
+    monkeypatch.setattr(nuka, 'loop', loop)
+    hosts = [base.BaseHost(address='rolling{0}'.format(i), loop=loop)
+             for i in range(10)]
+    names = [h.name for h in hosts]
+    batches = []
+
+    def on_batch(hosts, results):
+        batches.append(results)
+
+    res, started = run_rolling(hosts, batch_size=3, on_batch=on_batch)
+    assert res == names
+    assert [len(b) for b in batches] == [3, 3, 3, 1]
+
+    batches[:] = []
+    res, started = run_rolling(hosts, batch_size='25%', on_batch=on_batch)
+    assert [len(b) for b in batches] == [3, 3, 3, 1]
+
+    # failures are returned and stop the next batches
+    res, started = run_rolling(hosts, batch_size=2, max_failures='20%',
+                               fail=names[1:4])
+    # the 2nd failure stopped the 2nd batch
+    assert started == names[:3]
+    assert caplog.records[-1].levelname == 'ERROR'
+    assert 'Stopped after 2 failure(s). 7 host(s)' in caplog.records[-1].msg
+    assert res[0] == names[0]
+    assert [str(r) for r in res[1:]] == names[1:3]
+
+    # one failure is not enough to stop
+    res, started = run_rolling(hosts, batch_size=5, max_failures=2,
+                               fail=names[:1])
+    assert len(res) == 10
+    assert isinstance(res[0], RuntimeError)
+
+    # on_batch can stop. this is not an error
+    caplog.set_level('INFO')
+    res, started = run_rolling(hosts, batch_size=4,
+                               on_batch=lambda h, r: False)
+    assert started == names[:4]
+    assert res == names[:4]
+    assert caplog.records[-1].levelname == 'INFO'
+    assert 'Stopped by on_batch. 6 host(s)' in caplog.records[-1].msg
+    loop.close()
@@ -1,11 +1,14 @@
 # -*- coding: utf-8 -*-
+import io
 import os
 import sys
 import pytest
+import tarfile
 import subprocess
 
 import nuka
 from nuka import utils
+from nuka import remote
 from nuka import config
 from nuka.remote.task import Task
 
@@ -63,6 +66,26 @@ def test_simple_script(script_process, remote_stdin):
     assert data['rc'] == 0
 
 
+def test_sh_output():
+    task = command()
+    stdin = b'x' * 100000
+    res = task.sh(['cat'], stdin=stdin, output='tail')
+    assert res['stdout'] == 'x' * Task.output_tail
+    assert task.remote_calls[-1]['stdout'] == res['stdout']
+    res = task.sh(['cat'], stdin=stdin, output='spool')
+    with open(res['stdout_file'], 'rb') as fd:
+        assert fd.read() == stdin
+    os.remove(res['stdout_file'])
+    os.remove(res['stderr_file'])
+
+    # remote_calls keep output_tail bytes, not characters
+    res = task.sh(['cat'], stdin=u'\xe9'.encode('utf8') * Task.output_tail)
+    assert len(res['stdout']) == Task.output_tail
+    tail = task.remote_calls[-1]['stdout']
+    assert len(tail.encode('utf8')) == Task.output_tail
+    assert tail == u'\xe9' * (Task.output_tail // 2)
+
+
 def test_kill_script(script_process, remote_stdin):
     p = script_process()
     data = remote_stdin(cmd=['sleep', '5'])
@@ -74,3 +97,166 @@ def test_kill_script(script_process, remote_stdin):
     data = utils.proto_loads_std(stdout)
     assert data['rc'] == 1, data
     assert data['signal'] == 'SIGINT'
+
+
+def test_agent_script(script_process, remote_stdin):
+    p = script_process('--agent')
+    data = remote_stdin(request_id=1, cmd=['sleep', '5'])
+    data += remote_stdin(request_id=2)
+    data += utils.proto_dumps(dict(signal='SIGINT', request_id=1))
+    stdout, stderr = p.communicate(data)
+    assert p.returncode == 0
+    assert not stderr
+    messages = {}
+    while stdout:
+        message, stdout = utils.proto_split(stdout)
+        data = utils.proto_loads_std(message)
+        messages[data['request_id']] = data
+    assert messages[1]['rc'] == 1
+    assert messages[1]['signal'] == 'SIGINT'
+    assert messages[2]['rc'] == 0
+    assert messages[2]['stdout'] == 'bear\n'
+
+
+@pytest.fixture
+def archives(tmpdir, monkeypatch):
+    monkeypatch.setitem(config, 'nuka_dir', str(tmpdir.join('nuka_dir')))
+    remote.build_archive.archives.clear()
+    yield remote.build_archive
+    remote.build_archive.archives.clear()
+
+
+def test_archive_cache(archives, monkeypatch):
+    data = remote.build_archive()
+    digest = remote.build_archive.digests['x:gz']
+    # rebuilding must reuse the archive cached in nuka_dir
+    remote.build_archive.archives.clear()
+    assert remote.build_archive() == data
+    assert remote.build_archive.digests['x:gz'] == digest
+
+    # the stub script is part of the key
+    filenames, dirnames = remote.archive_files()
+    key = remote.archive_key(filenames, 'x:gz')
+    monkeypatch.setattr(remote, 'SCRIPT', b'')
+    assert remote.archive_key(filenames, 'x:gz') != key
+
+
+def test_setup_cmd(archives, tmpdir):
+    from nuka.task import setup
+    data = remote.build_archive()
+    digest = remote.build_archive.digests['x:gz']
+    tmpdir.join('noop.py').write('')
+    conf = dict(remote_tmp=str(tmpdir.join('tmp')),
+                remote_dir=str(tmpdir.join('nuka')),
+                remote_cache=str(tmpdir.join('cache')),
+                script=str(tmpdir.join('noop.py')))
+    archive = tmpdir.join('cache', digest + '.tar.gz')
+    cmd = setup.setup_cmd.format('', len(data), conf, str(archive), digest)
+
+    def run():
+        p = subprocess.Popen(['bash', '-c', cmd], stdin=subprocess.PIPE,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = p.communicate(data)
+        return p.returncode, stdout.strip()
+
+    assert run() == (0, b'upload')
+    assert tmpdir.join('nuka', 'script.py').check()
+    assert oct(tmpdir.join('cache').stat().mode & 0o777) == oct(0o700)
+    assert run() == (0, b'cached')
+
+    # a corrupted archive is uploaded again
+    archive.write('x')
+    assert run() == (0, b'upload')
+    assert archive.read('rb') == data
+
+    # the cache dir must not be a link. the archive is uploaded without
+    # using the cache
+    tmpdir.join('nuka').remove()
+    tmpdir.join('cache').rename(tmpdir.join('other'))
+    tmpdir.join('cache').mksymlinkto(tmpdir.join('other'))
+    tmpdir.join('other', digest + '.tar.gz').write('x')
+    assert run() == (0, b'upload')
+    assert tmpdir.join('nuka', 'script.py').check()
+    assert tmpdir.join('other', digest + '.tar.gz').read() == 'x'
+    assert tmpdir.join('other').listdir() == [
+        tmpdir.join('other', digest + '.tar.gz')]
+
+
+def test_archive_script(archives, tmpdir):
+    data = remote.build_archive()
+    with tarfile.open(fileobj=io.BytesIO(data), mode='r:gz') as tfd:
+        tfd.extractall(str(tmpdir))
+    p = subprocess.Popen(
+        [sys.executable, str(tmpdir.join('script.py'))],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE)
+    stdout, stderr = p.communicate(utils.proto_dumps(dict(
+        task=('nuka.tasks.file', 'exists'), args={'dst': str(tmpdir)},
+        diff_mode=False, log_level=40, remote_tmp=str(tmpdir))))
+    res = utils.proto_loads_std(stdout)
+    assert res['rc'] == 0, res
+
+
+def test_inventory_cache(tmpdir, monkeypatch):
+    from nuka.inventory import operating_system
+    from nuka.tasks.setup import setup
+    calls = []
+
+    def update_inventory(inventory):
+        # modules can extend keys set by previous modules
+        calls.append(inventory)
+        inventory['python']['extended'] = True
+        inventory['os'] = {'name': 'test'}
+
+    monkeypatch.setattr(operating_system, 'update_inventory',
+                        update_inventory)
+    cache = tmpdir.join('inventory.json')
+    monkeypatch.setattr(sys, 'argv', [
+        'script.py', '--setup',
+        '--inventory=nuka.inventory.operating_system',
+        '--inventory-cache=' + str(cache)])
+    inventory = setup.get_inventory()['inventory']
+    assert inventory['python']['extended'] is True
+    inventory = setup.get_inventory()['inventory']
+    assert len(calls) == 1
+    assert inventory['python']['extended'] is True
+    assert inventory['os'] == {'name': 'test'}
+
+    # outdated
+    monkeypatch.setattr(operating_system, 'inventory_key', lambda: 'new')
+    setup.get_inventory()
+    assert len(calls) == 2
+    monkeypatch.setattr(operating_system, 'inventory_ttl', 0)
+    setup.get_inventory()
+    assert len(calls) == 3
+
+    # invalid caches are ignored
+    monkeypatch.setattr(operating_system, 'inventory_ttl', 3600)
+    for data in ('[]', '{"nuka.inventory.operating_system": {"time": 1}}',
+                 '{"nuka.inventory.operating_system": 1}', '{'):
+        cache.write(data)
+        setup.get_inventory()
+    assert len(calls) == 7
+
+
+def test_libraries_key(tmpdir, monkeypatch):
+    from nuka.inventory import libraries
+    site = tmpdir.mkdir('site-packages')
+    monkeypatch.setattr(sys, 'path', [str(tmpdir), str(site)])
+    key = libraries.inventory_key()
+    assert libraries.inventory_key() == key
+    # a new library changes the key
+    site.mkdir('lxml')
+    os.utime(str(site), (1, 1))
+    assert libraries.inventory_key() != key
+
+
+def test_net_inventory(monkeypatch):
+    from nuka.inventory import net
+    inventory = {}
+    assert net.update_inventory(inventory) is None
+    assert 'ifaces' in inventory
+    # the primary interface depends on the default route
+    key = net.inventory_key()
+    monkeypatch.setattr(net, 'get_route_address', lambda: '198.51.100.1')
+    assert net.inventory_key() != key
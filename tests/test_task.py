@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 import pytest
 
+import nuka
 from nuka.task import Task
+from nuka.tasks.shell import command
 
 
 @pytest.mark.asyncio
@@ -13,3 +15,25 @@ async def test_error(host):
 
     with pytest.raises(OSError):
         await ErrTask()
+
+
+@pytest.mark.asyncio
+async def test_agent(host):
+    host.vars['use_agent'] = True
+    try:
+        res = await nuka.wait(command(['echo', 'a']), command(['echo', 'b']))
+        assert [r.stdout for r in res] == ['a\n', 'b\n']
+    finally:
+        host.vars.pop('use_agent')
+        await host.close_agents()
+
+
+@pytest.mark.asyncio
+async def test_batch(host):
+    host.vars['use_batch'] = True
+    try:
+        res = await nuka.wait(command(['echo', 'a']), command(['echo', 'b']))
+        assert [r.stdout for r in res] == ['a\n', 'b\n']
+    finally:
+        host.vars.pop('use_batch')
+        await host.close_agents()
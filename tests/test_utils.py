@@ -1,7 +1,43 @@
 # -*- coding: utf-8 -*-
+import pytest
 from nuka import utils
 
 
 def test_json():
     assert utils.proto_loads_std(
         b'Content-type: plain\nContent-Length: 2\n{}') == {}
+
+
+def test_compression():
+    data = utils.proto_dumps({'a': 1}, content_type='zlib')
+    assert data.startswith(b'Content-type: plain\n')
+    message = {'stdout': 'x' * utils.ZLIB_MIN_SIZE}
+    data = utils.proto_dumps(message, content_type='zlib')
+    assert data.startswith(b'Content-type: zlib\n')
+    assert utils.proto_loads_std(data) == message
+
+
+@pytest.mark.skipif(utils.msgpack is None, reason='msgpack is required')
+def test_msgpack():
+    message = {'stdout': 'x' * utils.ZLIB_MIN_SIZE, 'rc': 0}
+    for content_type in ('msgpack', 'msgpack+zlib'):
+        data = utils.proto_dumps(message, content_type=content_type)
+        assert data.startswith(
+            'Content-type: {0}\n'.format(content_type).encode('utf8'))
+        assert utils.proto_loads_std(data) == message
+
+
+def test_binary():
+    data = utils.proto_dumps_binary(b'\x00\xff', request_id=1)
+    assert utils.proto_params(data) == {'request_id': '1'}
+    assert utils.proto_loads_std(data) == b'\x00\xff'
+
+
+def test_fingerprints(tmpdir):
+    filename = str(tmpdir.join('file'))
+    res = utils.fingerprints([filename])
+    assert res == {filename: None}
+    with open(filename, 'w') as fd:
+        fd.write('yo')
+    res = utils.fingerprints([filename])
+    assert res[filename][1] == 2